@@ -0,0 +1,268 @@
+"""Offline benchmark: replays a recorded video and a transcript script through
+the tool layer against local stand-ins for Anthropic, ElevenLabs and dbutils.
+
+    python bench.py --video desk.mp4 --script script.jsonl --out report.json
+    python bench.py --video desk.mp4 --script script.jsonl --compare report.json
+
+Each script line is a JSON object such as
+    {"at": 2.0, "text": "what do you see in front of you?"}
+    {"at": 5.0, "path": "use_recall", "text": "where did I leave my keys?"}
+    {"at": 9.0, "path": "voice.recall_item", "arguments": {"item": "keys", "user_query": "where are my keys"}}
+where path is one of use_user_input (default), use_current_image, use_loop,
+use_recall or voice.<handler>.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+
+import stubs
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+    }
+
+
+def load_script(path):
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return sorted(events, key=lambda event: event.get("at", 0.0))
+
+
+def run_in_daemon(loop, fn, *args):
+    # Like asyncio.to_thread, but on a daemon thread: a use_loop that never
+    # sees its condition must not keep the benchmark from exiting.
+    future = loop.create_future()
+
+    def target():
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(_set_exception, future, e)
+        else:
+            loop.call_soon_threadsafe(_set_result, future, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+class FakeLLM:
+    async def request_image_frame(self, user_id=None, text_content=None):
+        pass
+
+
+class FirstAudio:
+    # Trace exporter collecting time-to-first-audio per request.
+    def __init__(self):
+        self.values = []
+
+    def __call__(self, span):
+        if span.name == "first_audio":
+            self.values.append(span.duration)
+
+
+async def replay(events, tools, timeout):
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    latencies = {}
+    timeouts = {}
+
+    async def run(event):
+        path = event.get("path", "use_user_input")
+        text = event.get("text", "")
+        start = time.perf_counter()
+        if path.startswith("voice."):
+            import voice
+
+            handler = getattr(voice, path.split(".", 1)[1])
+            done = loop.create_future()
+
+            async def result_callback(result):
+                _set_result(done, result)
+
+            arguments = event.get("arguments") or {"user_request": text, "condition": text}
+            await handler(
+                tools.default_session, path, "bench", arguments, FakeLLM(), None, result_callback
+            )
+            work = done if path.endswith("wait_for_condition") or path.endswith("recall_item") else None
+        else:
+            work = run_in_daemon(loop, _traced(tools, path), text)
+        try:
+            if work is not None:
+                await asyncio.wait_for(work, timeout)
+        except asyncio.TimeoutError:
+            timeouts[path] = timeouts.get(path, 0) + 1
+            return
+        latencies.setdefault(path, []).append(time.perf_counter() - start)
+
+    tasks = []
+    for event in events:
+        delay = event.get("at", 0.0) - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run(event)))
+    await asyncio.gather(*tasks)
+    return latencies, timeouts
+
+
+def _traced(tools, path):
+    fn = getattr(tools, path)
+
+    def call(text):
+        if path != "use_user_input":
+            tools.tracing.start_request()
+        return fn(text)
+
+    return call
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for path, stats in report["latency"].items():
+        before = baseline.get("latency", {}).get(path)
+        if not before or before.get("p95") is None or stats["p95"] is None:
+            continue
+        if stats["p95"] > before["p95"] * (1 + tolerance):
+            regressions.append(f"{path}: p95 {before['p95']:.3f}s -> {stats['p95']:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--script", required=True)
+    parser.add_argument("--fps", type=float, help="replay rate, default: the video's")
+    parser.add_argument("--llm-latency", type=float, default=0.4)
+    parser.add_argument("--llm-jitter", type=float, default=0.1)
+    parser.add_argument("--tts-latency", type=float, default=0.15)
+    parser.add_argument("--tts-jitter", type=float, default=0.05)
+    parser.add_argument("--db-latency", type=float, default=0.05)
+    parser.add_argument("--db-jitter", type=float, default=0.01)
+    parser.add_argument("--yes-rate", type=float, default=0.1)
+    parser.add_argument("--rpm", type=int, help="stub API rate limit, requests/min")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    # the run happens in a scratch directory; paths given are relative to here
+    for name in ("video", "script", "out", "compare"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    if not os.path.exists(args.video):
+        parser.error(f"no such video: {args.video}")
+    events = load_script(args.script)
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    stub = stubs.StubServer(
+        llm=stubs.Latency(args.llm_latency, args.llm_jitter),
+        tts=stubs.Latency(args.tts_latency, args.tts_jitter),
+        yes_rate=args.yes_rate,
+        seed=args.seed,
+        rpm=args.rpm,
+    ).start()
+    db = stubs.install_dbutils(
+        os.path.join(workdir, "frames"), stubs.Latency(args.db_latency, args.db_jitter)
+    )
+    os.environ["ANTHROPIC_BASE_URL"] = stub.url
+    os.environ["ANTHROPIC_API_KEY"] = "stub"
+    os.chdir(workdir)
+
+    import capture
+    import ingest
+    import scene
+    import speech
+    import tools
+
+    tools.set_speaker(
+        speech.SpeechSink(
+            base_url=stub.url,
+            cache_dir=os.path.join(workdir, "speech_cache"),
+            player=[sys.executable, "-c", "import sys; sys.stdin.buffer.read()"],
+        )
+    )
+    # as the voice worker does before anyone joins
+    tools.warm_up()
+    first_audio = tools.tracing.add_exporter(FirstAudio())
+
+    fps = args.fps or cv2.VideoCapture(args.video).get(cv2.CAP_PROP_FPS) or 30.0
+    capture.camera = capture.CaptureService(args.video, fps=fps)
+    ingestor = ingest.Ingestor(tools.store_frame)
+    capture.camera.subscribe(
+        "ingest", tools._ingest_keyframes(ingestor, scene.KeyframeSelector()), fps=5
+    )
+    try:
+        capture.camera.start()
+        # give the buffer a frame before the first request
+        tools.frames.buffer.wait_newer(0, timeout=5)
+
+        started = time.monotonic()
+        latencies, timeouts = asyncio.run(replay(events, tools, args.timeout))
+        elapsed = time.monotonic() - started
+    finally:
+        capture.camera.stop()
+        ingestor.close(timeout=10)
+        stub.stop()
+
+    report = {
+        "elapsed_s": elapsed,
+        "latency": {path: summarize(values) for path, values in latencies.items()},
+        "first_audio": summarize(first_audio.values),
+        "timeouts": timeouts,
+        "vlm_calls_per_min": stub.stats.vlm_calls / (elapsed / 60),
+        "requests": stub.stats.requests,
+        "bytes_uploaded": stub.stats.bytes_in,
+        "frames_captured": capture.camera.captured,
+        "frames_ingested_per_s": len(db.stored) / elapsed,
+        "ingest": ingestor.stats(),
+        "memory": tools.memory_store().stats(),
+        "images": tools.imageprep.stats.report(),
+        "tokens": tools.tracing.tokens.summary(),
+        "governor": tools.governor.default.report(),
+        "startup": tools.tracing.startup.summary(),
+    }
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+import router
+import scene
+
+
+# Words a rephrasing may add or drop without changing the question. Anything
+# else ("on" vs "off", "left" vs "right") is content and has to match.
+FILLER = frozenset(
+    "a an the this that these those is are was were be am do does did can could "
+    "would will you your i me my it its what whats which who please tell see "
+    "there here just".split()
+)
+
+
+def content_words(query):
+    words = router.normalize(query).replace("'", " ").split()
+    return frozenset(word for word in words if word not in FILLER and len(word) > 1)
+
+
+class ResponseCache:
+    # Answers keyed on (frame fingerprint, normalized query). A lookup also
+    # matches a near-identical frame (dhash within max_distance bits). With
+    # similarity set, a rephrased query scoring at least that much matches
+    # too, but only if it has the same content words: trigrams put "is the
+    # stove on" and "is the stove off" at 0.84.
+    def __init__(self, ttl=10.0, maxsize=128, max_distance=4, similarity=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.max_distance = max_distance
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expire(self, now):
+        while self._entries:
+            key, (_, stored_at) = next(iter(self._entries.items()))
+            if now - stored_at <= self.ttl:
+                break
+            del self._entries[key]
+
+    def get(self, frame, query):
+        fingerprint = frame.fingerprint
+        query = router.normalize(query)
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get((fingerprint, query))
+            words = None
+            if entry is None:
+                for (fp, q), candidate in reversed(self._entries.items()):
+                    if scene.hamming(fp, fingerprint) > self.max_distance:
+                        continue
+                    if q == query:
+                        entry = candidate
+                        break
+                    if self.similarity is None or router.similarity(q, query) < self.similarity:
+                        continue
+                    if words is None:
+                        words = content_words(query)
+                    if content_words(q) == words:
+                        entry = candidate
+                        break
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, frame, query, answer):
+        key = (frame.fingerprint, router.normalize(query))
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (answer, time.monotonic())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
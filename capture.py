@@ -0,0 +1,159 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+
+import frames
+
+
+class Subscription:
+    # A consumer of captured frames. Frames are offered at most fps times a
+    # second and queued up to maxsize; when full, "drop_oldest" makes room
+    # for the new frame and "drop_newest" discards it. With a callback the
+    # subscription runs its own delivery thread, otherwise call get().
+    def __init__(self, name, callback=None, fps=None, maxsize=1, policy="drop_oldest"):
+        if policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"unknown policy {policy!r}")
+        self.name = name
+        self.interval = 1.0 / fps if fps else 0.0
+        self.maxsize = maxsize
+        self.policy = policy
+        self._callback = callback
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._last = 0.0
+        self._closed = False
+        self.delivered = 0
+        self.dropped = 0
+        self._thread = None
+        if callback is not None:
+            self._thread = threading.Thread(
+                target=self._run, name=f"capture-{name}", daemon=True
+            )
+            self._thread.start()
+
+    def offer(self, frame):
+        if frame.timestamp - self._last < self.interval:
+            return
+        self._last = frame.timestamp
+        with self._cond:
+            if len(self._queue) >= self.maxsize:
+                self.dropped += 1
+                if self.policy == "drop_newest":
+                    return
+                self._queue.popleft()
+            self._queue.append(frame)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        with self._cond:
+            self._cond.wait_for(lambda: self._queue or self._closed, timeout)
+            if not self._queue:
+                return None
+            self.delivered += 1
+            return self._queue.popleft()
+
+    def _run(self):
+        while True:
+            frame = self.get()
+            if frame is None:
+                return
+            try:
+                self._callback(frame)
+            except Exception as e:
+                print(f"ERROR: {self.name} subscriber failed: {e!r}")
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+
+class CaptureService:
+    # The only owner of the camera. A dedicated thread reads and decodes each
+    # frame once, pushes it into the shared frame buffer (which current-image
+    # queries and watches read) and offers it to every subscriber. fps paces
+    # reads, for replaying a video file at its recorded speed.
+    def __init__(self, device=0, buffer=frames.buffer, fps=None):
+        self.device = device
+        self.buffer = buffer
+        self.fps = fps
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.captured = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def subscribe(self, name, callback=None, fps=None, maxsize=1, policy="drop_oldest"):
+        subscription = Subscription(name, callback, fps, maxsize, policy)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+        subscription.close()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            subscriptions, self._subscriptions = self._subscriptions, []
+        for subscription in subscriptions:
+            subscription.close()
+
+    def _run(self):
+        cam = cv2.VideoCapture(self.device)
+        interval = 1.0 / self.fps if self.fps else 0.0
+        next_read = time.monotonic()
+        try:
+            while cam.isOpened() and not self._stop.is_set():
+                if interval:
+                    next_read += interval
+                    time.sleep(max(0.0, next_read - time.monotonic()))
+                ret, image = cam.read()
+                if not ret:
+                    break
+                frame = self.buffer.push(image, time.time())
+                self.captured += 1
+                with self._lock:
+                    subscriptions = list(self._subscriptions)
+                for subscription in subscriptions:
+                    subscription.offer(frame)
+        finally:
+            cam.release()
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+            for subscription in subscriptions:
+                subscription.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "captured": self.captured,
+                "subscribers": {
+                    s.name: {"delivered": s.delivered, "dropped": s.dropped}
+                    for s in self._subscriptions
+                },
+            }
+
+
+camera = CaptureService()
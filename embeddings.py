@@ -0,0 +1,34 @@
+import importlib.util
+import threading
+
+
+MODEL_NAME = "clip-ViT-B-32"
+DIM = 512
+
+_model = None
+_lock = threading.Lock()
+
+
+def available():
+    # Checked without importing it: sentence_transformers pulls in torch.
+    return importlib.util.find_spec("sentence_transformers") is not None
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def image(img):
+    # img is a PIL image; CLIP embeds images and text into the same space.
+    return _get_model().encode(img)
+
+
+def text(query):
+    return _get_model().encode(query)
@@ -0,0 +1,167 @@
+import base64
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+import scene
+
+
+LATEST_PATH = "latest.jpeg"
+
+
+def estimate_image_tokens(width, height):
+    # Anthropic bills roughly width * height / 750 tokens per image, after
+    # scaling anything over ~1.15 megapixels down.
+    scale = min(1.0, (1_150_000 / (width * height)) ** 0.5)
+    return int(width * scale * height * scale / 750)
+
+
+class Frame:
+    # A captured frame. The JPEG and base64 encodings are computed on first use
+    # and cached, so every tool reading the same frame shares one encode.
+    # jpeg may be any buffer, e.g. a memoryview into a segment file.
+    def __init__(self, seq, timestamp, image=None, jpeg=None, fingerprint=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self._image = image
+        self._jpeg = jpeg
+        self._base64 = None
+        self._fingerprint = fingerprint
+        self._thumbnail = None
+        self._prepared = {}
+        self._lock = threading.Lock()
+
+    @property
+    def image(self):
+        if self._image is None and self._jpeg is not None:
+            with self._lock:
+                if self._image is None:
+                    self._image = cv2.imdecode(
+                        np.frombuffer(self._jpeg, dtype=np.uint8), cv2.IMREAD_COLOR
+                    )
+        return self._image
+
+    @property
+    def jpeg(self):
+        if self._jpeg is None:
+            with self._lock:
+                if self._jpeg is None:
+                    ok, buf = cv2.imencode(".jpg", self._image)
+                    if not ok:
+                        raise ValueError(f"could not encode frame {self.seq}")
+                    self._jpeg = buf.tobytes()
+        return self._jpeg
+
+    @property
+    def base64(self):
+        if self._base64 is None:
+            data = base64.b64encode(self.jpeg).decode("utf-8")
+            with self._lock:
+                if self._base64 is None:
+                    self._base64 = data
+        return self._base64
+
+    def prepared(self, key, build):
+        # Per-frame cache for derived encodings (see imageprep).
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            prepared = build()
+            with self._lock:
+                prepared = self._prepared.setdefault(key, prepared)
+        return prepared
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = scene.dhash(self.image)
+        return self._fingerprint
+
+    @property
+    def thumbnail(self):
+        if self._thumbnail is None:
+            self._thumbnail = scene.thumbnail(self.image)
+        return self._thumbnail
+
+
+class FrameBuffer:
+    def __init__(self, size=30):
+        self._frames = deque(maxlen=size)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def push(self, image, timestamp=None):
+        with self._cond:
+            self._seq += 1
+            frame = Frame(self._seq, timestamp or time.time(), image=image)
+            self._frames.append(frame)
+            self._cond.notify_all()
+        return frame
+
+    def latest(self):
+        with self._cond:
+            return self._frames[-1] if self._frames else None
+
+    def frames(self):
+        with self._cond:
+            return list(self._frames)
+
+    def wait_newer(self, seq, timeout=None):
+        # Block until a frame with a sequence number greater than seq arrives.
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._frames and self._frames[-1].seq > seq, timeout
+            )
+            if self._frames and self._frames[-1].seq > seq:
+                return self._frames[-1]
+            return None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._frames)
+
+
+buffer = FrameBuffer()
+
+_disk_lock = threading.Lock()
+_disk_frame = None
+_disk_key = None
+
+
+def _read_latest_file():
+    # Fallback for processes without a capture loop, where latest.jpeg is
+    # written by another process. Re-read only when the file has changed.
+    global _disk_frame, _disk_key
+    try:
+        st = os.stat(LATEST_PATH)
+    except FileNotFoundError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    with _disk_lock:
+        if key != _disk_key:
+            with open(LATEST_PATH, "rb") as image_file:
+                data = image_file.read()
+            # a half-written JPEG lacks the end-of-image marker; keep the old one
+            if not data.endswith(b"\xff\xd9") and _disk_frame is not None:
+                return _disk_frame
+            _disk_frame = Frame(st.st_mtime_ns, st.st_mtime, jpeg=data)
+            _disk_key = key
+        return _disk_frame
+
+
+def load(path):
+    with open(path, "rb") as image_file:
+        data = image_file.read()
+    return Frame(0, os.path.getmtime(path), jpeg=data)
+
+
+def current():
+    frame = buffer.latest()
+    if frame is None:
+        frame = _read_latest_file()
+    if frame is None:
+        raise RuntimeError("no frame available")
+    return frame
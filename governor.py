@@ -0,0 +1,479 @@
+import asyncio
+import bisect
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+
+# Priority classes, most urgent first.
+INTERACTIVE = 0
+RECALL = 1
+WATCH = 2
+NAMES = {INTERACTIVE: "interactive", RECALL: "recall", WATCH: "watch"}
+
+# Rough input cost of one image, corrected by real usage after the call.
+IMAGE_TOKENS = 800
+
+
+def estimate_tokens(request):
+    tokens = min(request.get("max_tokens", 0), 200)
+    for block in request.get("system") or []:
+        tokens += len(block.get("text", "")) // 4
+    for message in request.get("messages", []):
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for block in content:
+            tokens += IMAGE_TOKENS if block["type"] == "image" else len(block.get("text", "")) // 4
+    return tokens
+
+
+def request_key(request):
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def response_tokens(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return usage.input_tokens + usage.output_tokens
+
+
+def failure(e):
+    # ("rate_limited", retry_after) for 429/529, ("transient", None) for
+    # other errors worth retrying, None otherwise.
+    status = getattr(e, "status_code", None)
+    if status in (429, 529):
+        response = getattr(e, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return "rate_limited", float(retry_after) if retry_after else None
+        except ValueError:
+            return "rate_limited", None
+    if (status is not None and status >= 500) or type(e).__name__ in (
+        "APIConnectionError",
+        "APITimeoutError",
+    ):
+        return "transient", None
+    return None
+
+
+class Budget:
+    # Requests and tokens spent in a rolling window; None means unlimited.
+    def __init__(self, tokens=None, requests=None, window=60.0):
+        self.tokens = tokens
+        self.requests = requests
+        self.window = window
+        self._spent = deque()
+        self._used = 0
+
+    def _trim(self, now):
+        while self._spent and now - self._spent[0][0] > self.window:
+            self._used -= self._spent.popleft()[1]
+
+    def usage(self, now):
+        # Fraction of the tighter limit in use.
+        self._trim(now)
+        ratios = [0.0]
+        if self.tokens:
+            ratios.append(self._used / self.tokens)
+        if self.requests:
+            ratios.append(len(self._spent) / self.requests)
+        return max(ratios)
+
+    def fits(self, tokens, now, share=1.0):
+        self._trim(now)
+        if not self._spent:
+            # an idle budget lets even an oversized request through
+            return True
+        if self.tokens is not None and self._used + tokens > self.tokens * share:
+            return False
+        if self.requests is not None and len(self._spent) + 1 > self.requests * share:
+            return False
+        return True
+
+    def charge(self, tokens, now):
+        entry = [now, tokens]
+        self._spent.append(entry)
+        self._used += tokens
+        return entry
+
+    def correct(self, entry, tokens):
+        if any(spent is entry for spent in self._spent):
+            self._used += tokens - entry[1]
+            entry[1] = tokens
+
+
+class _Waiter:
+    def __init__(self, priority, tokens, session, wake):
+        self.priority = priority
+        self.tokens = tokens
+        self.session = session
+        self.wake = wake
+        self.enqueued = time.monotonic()
+        self.grant = None
+
+
+class Grant:
+    def __init__(self, governor, waiter, entries):
+        self._governor = governor
+        self.priority = waiter.priority
+        self.session = waiter.session
+        self.estimate = waiter.tokens
+        self._entries = entries
+        self._released = False
+
+    def release(self, tokens=None, rate_limited=False, retry_after=None):
+        self._governor._release(self, tokens, rate_limited, retry_after)
+
+
+class Governor:
+    # Central scheduler for VLM requests. Waiting requests are granted in
+    # priority order (interactive > recall > watch) as long as there is a
+    # free concurrency slot and room in the global and per-session budgets.
+    # Watch polling only gets watch_share of the slots and the global
+    # budget, so the rest is always left for user-facing answers. A 429
+    # pauses all grants with exponential backoff, and pressure() tells
+    # pollers to slow down.
+    def __init__(
+        self,
+        concurrency=8,
+        tokens=None,
+        requests=None,
+        session_tokens=None,
+        session_requests=None,
+        watch_share=0.5,
+        max_backoff=30.0,
+    ):
+        self.concurrency = concurrency
+        self.watch_share = watch_share
+        self.max_backoff = max_backoff
+        self.budget = Budget(tokens, requests)
+        self._session_limits = (session_tokens, session_requests)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._paused_until = 0.0
+        self._backoff = 0.0
+        self._timer = None
+        self._inflight = {}
+        self.stats = {
+            name: {"granted": 0, "wait_s": 0.0, "rate_limited": 0, "coalesced": 0}
+            for name in NAMES.values()
+        }
+
+    @classmethod
+    def from_env(cls):
+        def number(name):
+            value = os.getenv(name)
+            return int(value) if value else None
+
+        return cls(
+            concurrency=number("VLM_CONCURRENCY") or 8,
+            tokens=number("VLM_TOKENS_PER_MIN"),
+            requests=number("VLM_REQUESTS_PER_MIN"),
+            session_tokens=number("SESSION_TOKENS_PER_MIN"),
+            session_requests=number("SESSION_REQUESTS_PER_MIN"),
+        )
+
+    def _session_budget(self, session):
+        budget = self._sessions.get(session)
+        if budget is None:
+            budget = self._sessions[session] = Budget(*self._session_limits)
+        return budget
+
+    def forget(self, session):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+    def pressure(self):
+        # 0.0 when idle, 1.0 when paused by a 429 or out of budget.
+        now = time.monotonic()
+        with self._lock:
+            if now < self._paused_until:
+                return 1.0
+            return min(
+                1.0,
+                max(
+                    self.budget.usage(now),
+                    self._active / self.concurrency,
+                    1.0 if self._waiters else 0.0,
+                ),
+            )
+
+    def slowdown(self):
+        # Factor for polling intervals: 1x when idle, up to 5x under pressure.
+        return 1.0 + 4.0 * self.pressure()
+
+    def _enqueue(self, priority, tokens, session, wake):
+        waiter = _Waiter(priority, tokens, session, wake)
+        with self._lock:
+            bisect.insort(self._waiters, (priority, next(self._seq), waiter), key=lambda w: w[:2])
+            self._dispatch()
+        return waiter
+
+    def _dispatch(self):
+        # Called with the lock held.
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._schedule(self._paused_until - now)
+            return
+        granted = []
+        for item in list(self._waiters):
+            waiter = item[2]
+            limit, share = self.concurrency, 1.0
+            if waiter.priority == WATCH:
+                limit = max(1, int(self.concurrency * self.watch_share))
+                share = self.watch_share
+            if self._active >= limit or not self.budget.fits(waiter.tokens, now, share):
+                if waiter.priority < WATCH:
+                    # nothing less urgent may take what this one is waiting for
+                    break
+                continue
+            session_budget = self._session_budget(waiter.session)
+            if not session_budget.fits(waiter.tokens, now):
+                continue
+            self._waiters.remove(item)
+            self._active += 1
+            entries = (
+                self.budget.charge(waiter.tokens, now),
+                session_budget.charge(waiter.tokens, now),
+            )
+            waiter.grant = Grant(self, waiter, entries)
+            stats = self.stats[NAMES[waiter.priority]]
+            stats["granted"] += 1
+            stats["wait_s"] += now - waiter.enqueued
+            granted.append(waiter)
+        if self._waiters and self._active < self.concurrency:
+            # blocked on a budget window; look again once some of it expires
+            self._schedule(0.25)
+        for waiter in granted:
+            waiter.wake(waiter.grant)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            return
+
+        def fire():
+            with self._lock:
+                self._timer = None
+                self._dispatch()
+
+        self._timer = threading.Timer(delay, fire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _release(self, grant, tokens, rate_limited, retry_after):
+        with self._lock:
+            if grant._released:
+                return
+            grant._released = True
+            self._active -= 1
+            if tokens is not None:
+                for entry, budget in zip(
+                    grant._entries, (self.budget, self._session_budget(grant.session))
+                ):
+                    budget.correct(entry, tokens)
+            if rate_limited:
+                self.stats[NAMES[grant.priority]]["rate_limited"] += 1
+                self._backoff = min(self.max_backoff, max(1.0, self._backoff * 2))
+                pause = retry_after or self._backoff * (0.5 + random.random())
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            else:
+                self._backoff /= 2
+            self._dispatch()
+
+    def _cancel(self, waiter):
+        with self._lock:
+            for item in self._waiters:
+                if item[2] is waiter:
+                    self._waiters.remove(item)
+                    return
+        if waiter.grant is not None:
+            waiter.grant.release()
+
+    def acquire(self, priority, tokens, session=None):
+        event = threading.Event()
+        waiter = self._enqueue(priority, tokens, session, lambda grant: event.set())
+        event.wait()
+        return waiter.grant
+
+    async def aacquire(self, priority, tokens, session=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake(grant):
+            loop.call_soon_threadsafe(_resolve, future, grant)
+
+        waiter = self._enqueue(priority, tokens, session, wake)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self._cancel(waiter)
+            raise
+
+    @contextmanager
+    def slot(self, priority, tokens, session=None):
+        # A grant for a call that cannot be coalesced or retried, e.g. a
+        # stream that is already being spoken. Call grant.release(tokens)
+        # with the real usage when known.
+        grant = self.acquire(priority, tokens, session)
+        try:
+            yield grant
+        except BaseException as e:
+            failed = failure(e)
+            grant.release(rate_limited=failed is not None and failed[0] == "rate_limited")
+            raise
+        grant.release()
+
+    @asynccontextmanager
+    async def aslot(self, priority, tokens, session=None):
+        grant = await self.aacquire(priority, tokens, session)
+        try:
+            yield grant
+        except BaseException as e:
+            failed = failure(e)
+            grant.release(rate_limited=failed is not None and failed[0] == "rate_limited")
+            raise
+        grant.release()
+
+    def _lead(self, key):
+        # Returns (future, True) for the first caller with this key and
+        # (future, False) for callers that should wait on its result.
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = self._inflight[key] = concurrent.futures.Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def call(self, fn, priority, tokens, session=None, key=None, retries=0):
+        # Runs fn() under a grant, retrying rate-limited and transient
+        # failures up to retries times. With a key, identical calls already
+        # in flight share one result instead of making another request. A
+        # leader that is cancelled does not pass that on: its followers go
+        # back to _lead and the first one makes the request itself.
+        if key is None:
+            return self._call(fn, priority, tokens, session, retries)
+        while True:
+            future, leader = self._lead(key)
+            if leader:
+                break
+            try:
+                result = future.result()
+            except _Abandoned:
+                continue
+            self.stats[NAMES[priority]]["coalesced"] += 1
+            return result
+        try:
+            result = self._call(fn, priority, tokens, session, retries)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(key, future, error=_Abandoned())
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def _call(self, fn, priority, tokens, session, retries):
+        for attempt in itertools.count():
+            grant = self.acquire(priority, tokens, session)
+            try:
+                result = fn()
+            except BaseException as e:
+                failed = failure(e)
+                limited = failed is not None and failed[0] == "rate_limited"
+                grant.release(rate_limited=limited, retry_after=failed and failed[1])
+                if failed is None or attempt >= retries:
+                    raise
+                if not limited:
+                    time.sleep(0.5 * 2**attempt)
+                continue
+            grant.release(response_tokens(result))
+            return result
+
+    async def acall(self, fn, priority, tokens, session=None, key=None, retries=0):
+        # Async call(); fn returns a fresh coroutine per attempt.
+        if key is None:
+            return await self._acall(fn, priority, tokens, session, retries)
+        while True:
+            future, leader = self._lead(key)
+            if leader:
+                break
+            try:
+                result = await asyncio.shield(asyncio.wrap_future(future))
+            except _Abandoned:
+                continue
+            self.stats[NAMES[priority]]["coalesced"] += 1
+            return result
+        try:
+            result = await self._acall(fn, priority, tokens, session, retries)
+        except Exception as e:
+            self._finish(key, future, error=e)
+            raise
+        except BaseException:
+            self._finish(key, future, error=_Abandoned())
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def _acall(self, fn, priority, tokens, session, retries):
+        for attempt in itertools.count():
+            grant = await self.aacquire(priority, tokens, session)
+            try:
+                result = await fn()
+            except BaseException as e:
+                failed = failure(e)
+                limited = failed is not None and failed[0] == "rate_limited"
+                grant.release(rate_limited=limited, retry_after=failed and failed[1])
+                if failed is None or attempt >= retries:
+                    raise
+                if not limited:
+                    await asyncio.sleep(0.5 * 2**attempt)
+                continue
+            grant.release(response_tokens(result))
+            return result
+
+    def report(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "waiting": len(self._waiters),
+                "backoff_s": self._backoff,
+                "classes": {name: dict(stats) for name, stats in self.stats.items()},
+            }
+
+
+class _Abandoned(Exception):
+    # Handed to coalesced followers when their leader was cancelled.
+    pass
+
+
+def _resolve(future, grant):
+    if future.done():
+        # the waiter was cancelled after being granted
+        grant.release()
+    else:
+        future.set_result(grant)
+
+
+default = Governor.from_env()
@@ -0,0 +1,162 @@
+import base64
+import math
+import re
+import threading
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+import frames
+import tracing
+
+
+class Profile:
+    def __init__(self, width, height, quality, fmt="jpeg"):
+        self.width = width
+        self.height = height
+        self.quality = quality
+        self.fmt = fmt
+
+    @property
+    def key(self):
+        return (self.width, self.height, self.quality, self.fmt)
+
+
+# Target size and quality per caller. Condition checks only need to spot an
+# object; answers get more pixels; DETAIL is used for reading and math.
+PROFILES = {
+    "use_current_image": Profile(768, 432, 80),
+    "use_recall": Profile(768, 432, 80),
+    "use_recall_grid": Profile(1152, 648, 80),
+    "use_loop": Profile(512, 288, 70),
+}
+DETAIL = Profile(1280, 720, 90)
+DEFAULT = Profile(768, 432, 80)
+
+_DETAIL_QUERY = re.compile(
+    r"\b(read|text|written|write|says?|sign|label|page|menu|book|solve|equation|"
+    r"math|number|digits?|code|small|tiny|detail|spell)\b",
+    re.IGNORECASE,
+)
+
+_MEDIA_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class PreparedImage:
+    def __init__(self, data, media_type, width, height):
+        self.data = data
+        self.media_type = media_type
+        self.width = width
+        self.height = height
+        self.base64 = base64.b64encode(data).decode("utf-8")
+        # the Messages API content block, shared by every request that
+        # sends this image
+        self.block = {
+            "type": "image",
+            "source": {"type": "base64", "media_type": media_type, "data": self.base64},
+        }
+
+    @property
+    def tokens(self):
+        return frames.estimate_image_tokens(self.width, self.height)
+
+
+def profile_for(tool, query=None):
+    if query and _DETAIL_QUERY.search(query):
+        return DETAIL
+    return PROFILES.get(tool, DEFAULT)
+
+
+def encode(image, profile):
+    height, width = image.shape[:2]
+    scale = min(1.0, profile.width / width, profile.height / height)
+    if scale < 1.0:
+        width, height = int(width * scale), int(height * scale)
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    if profile.fmt == "webp":
+        ok, buf = cv2.imencode(".webp", image, [cv2.IMWRITE_WEBP_QUALITY, profile.quality])
+    else:
+        ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, profile.quality])
+    if not ok:
+        raise ValueError(f"could not encode image as {profile.fmt}")
+    return PreparedImage(buf.tobytes(), _MEDIA_TYPES[profile.fmt], width, height)
+
+
+def composite(images, labels, tile=(576, 324)):
+    # Tiles BGR images into one grid, letterboxed, each with its label in
+    # the top-left corner, so several frames go to the VLM as one image.
+    cols = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / cols)
+    tile_w, tile_h = tile
+    grid = np.zeros((rows * tile_h, cols * tile_w, 3), np.uint8)
+    for i, (image, label) in enumerate(zip(images, labels)):
+        y, x = divmod(i, cols)
+        y, x = y * tile_h, x * tile_w
+        height, width = image.shape[:2]
+        scale = min(tile_w / width, tile_h / height)
+        width, height = int(width * scale), int(height * scale)
+        top, left = y + (tile_h - height) // 2, x + (tile_w - width) // 2
+        grid[top : top + height, left : left + width] = cv2.resize(
+            image, (width, height), interpolation=cv2.INTER_AREA
+        )
+        (text_w, text_h), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.8, 2)
+        cv2.rectangle(grid, (x, y), (x + text_w + 12, y + text_h + baseline + 12), (0, 0, 0), -1)
+        cv2.putText(
+            grid, label, (x + 6, y + text_h + 6), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2
+        )
+        # thin separators so tiles with similar content stay distinguishable
+        cv2.rectangle(grid, (x, y), (x + tile_w - 1, y + tile_h - 1), (255, 255, 255), 1)
+    return grid
+
+
+class UploadStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.by_tool = defaultdict(lambda: {"calls": 0, "bytes": 0, "tokens": 0})
+
+    def record(self, tool, prepared):
+        with self._lock:
+            stats = self.by_tool[tool]
+            stats["calls"] += 1
+            stats["bytes"] += len(prepared.data)
+            stats["tokens"] += prepared.tokens
+
+    def report(self):
+        with self._lock:
+            return {tool: dict(stats) for tool, stats in self.by_tool.items()}
+
+
+stats = UploadStats()
+
+
+def prepare(frame, tool, query=None):
+    # Downscaled, re-encoded image for a VLM request. The encoding is cached
+    # on the frame, so several tools asking for the same profile share it.
+    profile = profile_for(tool, query)
+    with tracing.span("encode", tool=tool) as span:
+        prepared = frame.prepared(profile.key, lambda: encode(frame.image, profile))
+        span.update(
+            width=prepared.width,
+            height=prepared.height,
+            bytes=len(prepared.data),
+            image_tokens=prepared.tokens,
+        )
+    stats.record(tool, prepared)
+    return prepared
+
+
+def encoded(frame, tool):
+    # The tool's encoding of frame for storage; not counted as an upload.
+    profile = PROFILES.get(tool, DEFAULT)
+    return frame.prepared(profile.key, lambda: encode(frame.image, profile))
+
+
+def adopt(frame, tool, width, height):
+    # Registers frame.jpeg, already encoded with the tool's profile, as that
+    # encoding, so prepare() sends the stored bytes as they are.
+    profile = PROFILES.get(tool, DEFAULT)
+    frame.prepared(
+        profile.key,
+        lambda: PreparedImage(frame.jpeg, _MEDIA_TYPES[profile.fmt], width, height),
+    )
@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import deque
+
+
+class Ingestor:
+    # Fixed pool of workers storing frames from a bounded queue. When the
+    # queue is full, "drop_oldest" evicts the oldest pending frame and
+    # "coalesce" replaces the newest pending frame, so the capture loop never
+    # blocks and memory stays bounded.
+    def __init__(self, store, workers=2, maxsize=8, policy="drop_oldest"):
+        if policy not in ("drop_oldest", "coalesce"):
+            raise ValueError(f"unknown policy {policy!r}")
+        self._store = store
+        self._queue = deque()
+        self._maxsize = maxsize
+        self._policy = policy
+        self._cond = threading.Condition()
+        self._closed = False
+        self._busy = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.stored = 0
+        self.failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._latency_last = 0.0
+        self._workers = [
+            threading.Thread(target=self._run, name=f"ingest-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, *args):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("ingestor is closed")
+            self.submitted += 1
+            if len(self._queue) >= self._maxsize:
+                self.dropped += 1
+                if self._policy == "drop_oldest":
+                    self._queue.popleft()
+                else:
+                    self._queue.pop()
+            self._queue.append(args)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                args = self._queue.popleft()
+                self._busy += 1
+            start = time.perf_counter()
+            try:
+                self._store(*args)
+            except Exception as e:
+                print("ERROR: storing frame failed: " + repr(e))
+                ok = False
+            else:
+                ok = True
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                self._busy -= 1
+                if ok:
+                    self.stored += 1
+                    self._latency_total += elapsed
+                    self._latency_max = max(self._latency_max, elapsed)
+                    self._latency_last = elapsed
+                else:
+                    self.failed += 1
+                self._cond.notify_all()
+
+    def depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth": len(self._queue),
+                "in_flight": self._busy,
+                "submitted": self.submitted,
+                "stored": self.stored,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "latency_avg": self._latency_total / self.stored if self.stored else 0.0,
+                "latency_max": self._latency_max,
+                "latency_last": self._latency_last,
+            }
+
+    def close(self, timeout=None):
+        # Stop accepting frames and let the workers drain what is queued.
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            worker.join(remaining)
@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import scene
+
+
+# HSV ranges (OpenCV hue is 0-180) per color word; several ranges are OR-ed.
+COLORS = {
+    "red": [((0, 80, 60), (10, 255, 255)), ((170, 80, 60), (180, 255, 255))],
+    "orange": [((10, 80, 60), (22, 255, 255))],
+    "yellow": [((22, 80, 60), (35, 255, 255))],
+    "green": [((35, 60, 40), (85, 255, 255))],
+    "blue": [((90, 80, 40), (130, 255, 255))],
+    "purple": [((130, 60, 40), (155, 255, 255))],
+    "violet": [((130, 60, 40), (155, 255, 255))],
+    "pink": [((155, 40, 80), (172, 255, 255))],
+    "white": [((0, 0, 200), (180, 30, 255))],
+    "black": [((0, 0, 0), (180, 255, 40))],
+}
+
+SCREEN_SIZE = (160, 90)
+SIGNATURE_SIZE = (32, 18)
+
+# "stops/leaves/disappears" conditions are met by absence, which a screen
+# for presence cannot rule out.
+_NEGATION = re.compile(
+    r"\b(no|not|none|nobody|nothing|without|empty|gone|leaves?|disappears?|"
+    r"stops?|missing|closed)\b|n't\b",
+    re.IGNORECASE,
+)
+_PERSON = re.compile(
+    r"\b(person|people|man|woman|men|women|someone|somebody|face|child|kid)s?\b",
+    re.IGNORECASE,
+)
+_CAT = re.compile(r"\b(cat|kitten)s?\b", re.IGNORECASE)
+
+
+def _hsv(frame):
+    def build():
+        small = cv2.resize(frame.image, SCREEN_SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+
+    return frame.prepared(("hsv",) + SCREEN_SIZE, build)
+
+
+def _signature(mask):
+    small = cv2.resize(mask, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32) / 255.0
+
+
+class ColorScreen:
+    # Candidate when enough pixels fall in any of the named colors' ranges.
+    # An empty mask all but rules the condition out, so misses are rarely
+    # double-checked.
+    fallback = 60.0
+
+    def __init__(self, colors, min_fraction=0.002):
+        self.name = "color:" + "+".join(colors)
+        self.ranges = [bounds for color in colors for bounds in COLORS[color]]
+        self.min_fraction = min_fraction
+
+    def __call__(self, frame):
+        hsv = _hsv(frame)
+        mask = np.zeros(hsv.shape[:2], np.uint8)
+        for low, high in self.ranges:
+            mask |= cv2.inRange(hsv, np.array(low, np.uint8), np.array(high, np.uint8))
+        found = np.count_nonzero(mask) >= self.min_fraction * mask.size
+        return found, _signature(mask)
+
+
+class DetectorScreen:
+    # Candidate when any of the OpenCV detectors (HOG people, Haar cascades)
+    # finds a box. The signature is the box mask, so a moving subject
+    # counts as a change. The detectors miss a lot (a face cascade sees no
+    # one turned away from the camera), so misses are double-checked often.
+    fallback = 1.0
+
+    def __init__(self, name, detectors, width=480):
+        self.name = name
+        self.detectors = detectors
+        self.width = width
+
+    def __call__(self, frame):
+        height, width = frame.image.shape[:2]
+        scale = min(1.0, self.width / width)
+        small = cv2.resize(frame.image, (int(width * scale), int(height * scale)))
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        mask = np.zeros(gray.shape, np.uint8)
+        for detect in self.detectors:
+            for x, y, w, h in detect(small, gray):
+                mask[y : y + h, x : x + w] = 255
+        return bool(mask.any()), _signature(mask)
+
+
+_detectors = {}
+_detectors_lock = threading.Lock()
+
+
+def _detector(name):
+    # Built once per process; None when this OpenCV build lacks it.
+    with _detectors_lock:
+        if name not in _detectors:
+            _detectors[name] = _build_detector(name)
+        return _detectors[name]
+
+
+def _build_detector(name):
+    if name == "hog_people":
+        if not hasattr(cv2, "HOGDescriptor"):
+            return None
+        hog = cv2.HOGDescriptor()
+        hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+        lock = threading.Lock()
+
+        def detect(image, gray):
+            with lock:
+                boxes, _ = hog.detectMultiScale(image, winStride=(8, 8))
+            return boxes
+
+        return detect
+    data = getattr(cv2, "data", None)
+    path = os.path.join(data.haarcascades, f"haarcascade_{name}.xml") if data else ""
+    if not os.path.exists(path):
+        return None
+    cascade = cv2.CascadeClassifier(path)
+    lock = threading.Lock()
+
+    def detect(image, gray):
+        with lock:
+            return cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=4)
+
+    return detect
+
+
+def screen_for(condition):
+    # A tier-1 screen that must fire whenever the condition could be met,
+    # or None when the condition is not something the CPU can screen for.
+    if _NEGATION.search(condition):
+        return None
+    colors = [
+        color for color in COLORS if re.search(rf"\b{color}\b", condition, re.IGNORECASE)
+    ]
+    if colors:
+        return ColorScreen(colors)
+    names = []
+    if _PERSON.search(condition):
+        names += ["hog_people", "frontalface_default"]
+    if _CAT.search(condition):
+        names += ["frontalcatface"]
+    detectors = [_detector(name) for name in names]
+    if not detectors or None in detectors:
+        return None
+    return DetectorScreen("detect:" + "+".join(names), detectors)
+
+
+class Prefilter:
+    # Decides per frame whether a condition is worth a VLM call. A frame
+    # escalates when the screen first fires, when what it found has changed
+    # (threshold on the signature), or every recheck seconds while it keeps
+    # firing, but never more often than every min_interval seconds. Without
+    # a candidate a frame is still escalated when the change gate passes
+    # it, at most every fallback seconds (the screen's own by default), in
+    # case the screen missed something.
+    def __init__(
+        self, screen, threshold=0.02, recheck=10.0, fallback=None, min_interval=1.0, gate=None
+    ):
+        self.screen = screen
+        self.threshold = threshold
+        self.recheck = recheck
+        self.fallback = fallback if fallback is not None else getattr(screen, "fallback", 60.0)
+        self.min_interval = min_interval
+        self._gate = gate or scene.ChangeGate()
+        self._last_seq = None
+        self._last_signature = None
+        self._last_time = time.monotonic()
+        self.screened = 0
+        self.escalated = 0
+
+    def should_escalate(self, frame):
+        if frame.seq == self._last_seq:
+            return False
+        self._last_seq = frame.seq
+        self.screened += 1
+        found, signature = self.screen(frame)
+        now = time.monotonic()
+        if self.escalated and now - self._last_time < self.min_interval:
+            escalate = False
+        elif not found:
+            escalate = now - self._last_time >= self.fallback and self._gate.should_check(frame)
+        else:
+            escalate = (
+                self._last_signature is None
+                or now - self._last_time >= self.recheck
+                or float(np.mean(np.abs(signature - self._last_signature))) >= self.threshold
+            )
+        if escalate:
+            self._last_time = now
+            self._last_signature = signature if found else None
+            self.escalated += 1
+        return escalate
+
+
+def for_condition(condition):
+    screen = screen_for(condition)
+    return None if screen is None else Prefilter(screen)
+
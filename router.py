@@ -0,0 +1,174 @@
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+
+TOOLS = ("use_current_image", "recall_previous_image", "use_loop")
+
+# High-precision phrasings. The first matching rule wins.
+RULES = [
+    (r"\b(tell|let|notify|alert|warn|ping) me (when|if|once|as soon as)\b", "use_loop"),
+    (r"\b(wait|watch|keep (an eye|looking|watching)|look out) (for|until)\b", "use_loop"),
+    (r"\b(find|spot|look for) (a|an|some)\b.*\b(around|anywhere|appears?)\b", "use_loop"),
+    (r"\bwhere (did|have) i (leave|left|put|set|place|drop)", "recall_previous_image"),
+    (r"\b(do|did|can) you (remember|recall)\b", "recall_previous_image"),
+    (r"\b(have|did) you seen?\b", "recall_previous_image"),
+    (r"\b(can'?t|cannot|couldn'?t) find\b", "recall_previous_image"),
+    (r"\b(earlier|before|last time|previously|just showed)\b", "recall_previous_image"),
+    (r"\bwhat (do|can) you see\b", "use_current_image"),
+    (r"\bin front of (you|me)\b", "use_current_image"),
+    (r"\b(read|solve|describe|identify) (this|that|the|what)\b", "use_current_image"),
+    (r"\b(right now|currently|at the moment)\b", "use_current_image"),
+]
+
+# Labelled utterances for the nearest-neighbour fallback.
+EXAMPLES = {
+    "use_current_image": [
+        "what do you see in front of you",
+        "solve this equation",
+        "what is the color of the object in front of you",
+        "what am i holding",
+        "read this for me",
+        "what does this sign say",
+        "how many fingers am i holding up",
+        "is this shirt clean",
+        "what brand is this",
+        "describe the room",
+    ],
+    "recall_previous_image": [
+        "i can't find my keys do you remember where i left them",
+        "what color was the triangle from the image i just showed you",
+        "where are my glasses",
+        "have you seen my phone",
+        "where did i put my wallet",
+        "i lost my remote",
+        "what was written on the whiteboard earlier",
+        "did i leave the stove on",
+    ],
+    "use_loop": [
+        "tell me when you see a red car",
+        "tell me when you see an animal that may be living in the water",
+        "tell me when you see a blue pen",
+        "let me know when the cat shows up",
+        "find a cat",
+        "alert me if someone walks in",
+        "wait until the light turns green",
+        "watch for the mail truck",
+        "keep looking for my dog",
+    ],
+}
+
+
+def normalize(text):
+    text = text.lower().replace("’", "'")
+    text = re.sub(r"[^a-z0-9' ]+", " ", text)
+    return " ".join(text.split())
+
+
+def _ngrams(text, n=3):
+    padded = f" {text} "
+    return Counter(padded[i : i + n] for i in range(len(padded) - n + 1))
+
+
+def _cosine(a, b):
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    if not dot:
+        return 0.0
+    norm = math.sqrt(sum(c * c for c in a.values())) * math.sqrt(
+        sum(c * c for c in b.values())
+    )
+    return dot / norm
+
+
+def similarity(a, b):
+    # Trigram cosine similarity of two utterances, 0.0 to 1.0.
+    return _cosine(_ngrams(normalize(a)), _ngrams(normalize(b)))
+
+
+class Router:
+    # Picks a tool locally from regex rules, then from trigram nearest
+    # neighbours over EXAMPLES. Only low-confidence utterances go to the LLM
+    # fallback. Trigrams see spelling, not meaning ("is the stove on" is
+    # 0.66 from a recall example), so a neighbour only decides when it is
+    # nearly verbatim and well clear of the other tools. Rule and LLM
+    # decisions are kept in an LRU keyed on the normalized text; neighbour
+    # decisions are not, so a wrong guess is not repeated for the process.
+    def __init__(self, threshold=0.75, margin=0.3, cache_size=512):
+        self.threshold = threshold
+        self.margin = margin
+        self.cache_size = cache_size
+        self._rules = [(re.compile(pattern), tool) for pattern, tool in RULES]
+        self._examples = [
+            (tool, _ngrams(normalize(text)))
+            for tool, texts in EXAMPLES.items()
+            for text in texts
+        ]
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.local = 0
+        self.fallbacks = 0
+
+    def classify(self, text):
+        # Returns (tool, confidence) without touching the cache.
+        tool, confidence, _ = self._classify(normalize(text))
+        return tool, confidence
+
+    def _classify(self, text):
+        # Also says whether the decision came from a rule.
+        for rule, tool in self._rules:
+            if rule.search(text):
+                return tool, 1.0, True
+        grams = _ngrams(text)
+        scores = dict.fromkeys(TOOLS, 0.0)
+        for tool, example in self._examples:
+            scores[tool] = max(scores[tool], _cosine(grams, example))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        (best, top), (_, second) = ranked[0], ranked[1]
+        if top - second < self.margin:
+            return best, min(top, top - second), False
+        return best, top, False
+
+    def lookup(self, text):
+        # Returns a tool if the cache or the local classifier is confident,
+        # otherwise None and the caller should ask the LLM.
+        key = normalize(text)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+        tool, confidence, ruled = self._classify(key)
+        if confidence < self.threshold:
+            return None
+        self.local += 1
+        if ruled:
+            self.remember(key, tool)
+        return tool
+
+    def remember(self, text, tool):
+        key = normalize(text)
+        with self._lock:
+            self._cache[key] = tool
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _fell_back(self, text, tool):
+        self.fallbacks += 1
+        if any(name in tool for name in TOOLS):
+            self.remember(text, tool)
+        return tool
+
+    def route(self, text, fallback):
+        tool = self.lookup(text)
+        if tool is None:
+            tool = self._fell_back(text, fallback(text))
+        return tool
+
+    async def aroute(self, text, fallback):
+        tool = self.lookup(text)
+        if tool is None:
+            tool = self._fell_back(text, await fallback(text))
+        return tool
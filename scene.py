@@ -0,0 +1,112 @@
+import time
+
+import cv2
+import numpy as np
+
+
+THUMBNAIL_SIZE = (32, 18)
+
+
+def dhash(image):
+    # 64-bit difference hash of a BGR frame.
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def thumbnail(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32) / 255.0
+
+
+def histogram(image):
+    small = cv2.resize(image, (160, 90), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 8], [0, 180, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
+
+
+def histogram_distance(a, b):
+    # Bhattacharyya distance, 0.0 (identical) to 1.0.
+    return float(cv2.compareHist(a, b, cv2.HISTCMP_BHATTACHARYYA))
+
+
+def difference(a, b):
+    # Mean absolute difference between two thumbnails, 0.0 (identical) to 1.0.
+    return float(np.mean(np.abs(a - b)))
+
+
+class ChangeGate:
+    # Decides whether a frame differs enough from the last evaluated one to be
+    # worth a VLM call. A static scene is still re-checked every max_staleness
+    # seconds.
+    def __init__(self, threshold=0.03, max_staleness=10.0):
+        self.threshold = threshold
+        self.max_staleness = max_staleness
+        self._last_seq = None
+        self._last_thumb = None
+        self._last_time = 0.0
+        self.checked = 0
+        self.skipped = 0
+
+    def should_check(self, frame):
+        now = time.monotonic()
+        if frame.seq == self._last_seq and now - self._last_time < self.max_staleness:
+            self.skipped += 1
+            return False
+        thumb = frame.thumbnail
+        if (
+            self._last_thumb is not None
+            and now - self._last_time < self.max_staleness
+            and difference(self._last_thumb, thumb) < self.threshold
+        ):
+            self.skipped += 1
+            return False
+        self._last_seq = frame.seq
+        self._last_thumb = thumb
+        self._last_time = now
+        self.checked += 1
+        return True
+
+
+class KeyframeSelector:
+    # Picks frames worth remembering: one whose hash or color histogram has
+    # moved far enough from the last stored keyframe, never more often than
+    # min_interval and at least every max_interval seconds.
+    def __init__(self, threshold=0.2, min_interval=0.5, max_interval=30.0):
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._last_time = None
+        self._last_hash = None
+        self._last_hist = None
+        self.selected = 0
+        self.rejected = 0
+
+    def novelty(self, frame):
+        if self._last_hash is None:
+            return 1.0
+        return max(
+            hamming(self._last_hash, frame.fingerprint) / 64,
+            histogram_distance(self._last_hist, histogram(frame.image)),
+        )
+
+    def should_store(self, frame):
+        if self._last_time is not None:
+            elapsed = frame.timestamp - self._last_time
+            if elapsed < self.min_interval or (
+                elapsed < self.max_interval and self.novelty(frame) < self.threshold
+            ):
+                self.rejected += 1
+                return False
+        self._last_time = frame.timestamp
+        self._last_hash = frame.fingerprint
+        self._last_hist = histogram(frame.image)
+        self.selected += 1
+        return True
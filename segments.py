@@ -0,0 +1,286 @@
+import mmap
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+
+KEY_PREFIX = "seg:"
+
+# One index row per stored frame. Rows are appended in seq order, so the
+# time column is sorted and range queries are a binary search.
+RECORD = np.dtype(
+    [
+        ("seq", "<i8"),
+        ("time", "<f8"),
+        ("offset", "<u8"),
+        ("fingerprint", "<u8"),
+        ("segment", "<u4"),
+        ("length", "<u4"),
+        ("width", "<u2"),
+        ("height", "<u2"),
+    ]
+)
+
+_SEGMENT_NAME = re.compile(r"^(\d{8})\.seg$")
+
+
+def key(seq):
+    return f"{KEY_PREFIX}{seq}"
+
+
+class Retention:
+    # Which frames survive compaction: everything from the last full
+    # seconds, then one frame per interval for each (age, interval) tier
+    # the frame is old enough for. Frames older than max_age are dropped.
+    def __init__(self, full=3600.0, tiers=((3600.0, 60.0), (86400.0, 600.0)), max_age=30 * 86400.0):
+        self.full = full
+        self.tiers = sorted(tiers)
+        self.max_age = max_age
+
+    def keep(self, times, now):
+        ages = now - times
+        keep = ages < self.full
+        if self.max_age is not None:
+            alive = ages < self.max_age
+        else:
+            alive = np.ones(len(times), dtype=bool)
+        intervals = np.zeros(len(times))
+        for age, interval in self.tiers:
+            intervals[ages >= age] = interval
+        for interval in np.unique(intervals[~keep & alive]):
+            if interval <= 0:
+                keep |= alive & ~keep & (intervals == interval)
+                continue
+            ids = np.flatnonzero(~keep & alive & (intervals == interval))
+            # the first frame of each interval-sized bucket
+            _, first = np.unique(np.floor(times[ids] / interval), return_index=True)
+            keep[ids[first]] = True
+        return keep & alive
+
+
+class SegmentStore:
+    # Append-only store of encoded frames. Frames are packed back to back
+    # into segment files of up to segment_bytes, and a fixed-width index
+    # records where each one is and when it was taken. Reads are slices of
+    # read-only memory maps, so a stored JPEG goes to base64 without being
+    # copied, decoded or re-encoded. compact() applies the retention policy
+    # and rewrites the segments that lost frames; it runs on its own each
+    # time a segment fills up. on_drop, if given, is called with the keys
+    # each compaction dropped, so indexes over the store can forget them.
+    def __init__(self, path, segment_bytes=64 << 20, retention=None, on_drop=None):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.retention = retention
+        self.on_drop = on_drop
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, "index.bin")
+        self._lock = threading.RLock()
+        self._maps = {}
+        self._active = None
+        self._active_file = None
+        self._index_stat = None
+        self._load()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:08d}.seg")
+
+    def _load(self):
+        with self._lock:
+            records = np.zeros(0, RECORD)
+            if os.path.exists(self._index_path):
+                records = np.fromfile(self._index_path, dtype=np.uint8)
+                # a row cut short by a crash is ignored (and overwritten)
+                usable = len(records) - len(records) % RECORD.itemsize
+                records = records[:usable].view(RECORD).copy()
+                self._index_stat = _stat(self._index_path)
+            self._set(records)
+            self._maps = {}
+            self._close_active()
+            self._next_seq = int(records["seq"][-1]) + 1 if len(records) else 1
+            segments = [
+                int(m.group(1))
+                for m in map(_SEGMENT_NAME.match, os.listdir(self.path))
+                if m
+            ]
+            self._next_segment = max(segments, default=-1) + 1
+
+    def _set(self, records):
+        self._rows = records
+        self._records = records
+        self._seqs = records["seq"]
+
+    def refresh(self):
+        # Pick up frames and compactions from another process.
+        try:
+            stat = _stat(self._index_path)
+        except FileNotFoundError:
+            return
+        if stat != self._index_stat:
+            self._load()
+
+    def __len__(self):
+        return len(self._records)
+
+    def owns(self, key):
+        return key.startswith(KEY_PREFIX)
+
+    def _close_active(self):
+        if self._active_file is not None:
+            self._active_file.close()
+        self._active = None
+        self._active_file = None
+
+    def append(self, data, timestamp, width=0, height=0, fingerprint=0):
+        # Stores one encoded frame and returns its key.
+        with self._lock:
+            if self._active is None or self._active_file.tell() + len(data) > self.segment_bytes:
+                rolled = self._active is not None
+                self._close_active()
+                if rolled and self.retention is not None:
+                    self.compact()
+                self._active = self._next_segment
+                self._next_segment += 1
+                self._active_file = open(self._segment_path(self._active), "ab")
+            offset = self._active_file.tell()
+            self._active_file.write(data)
+            self._active_file.flush()
+            row = np.zeros(1, RECORD)
+            row[0] = (
+                self._next_seq,
+                timestamp,
+                offset,
+                fingerprint,
+                self._active,
+                len(data),
+                width,
+                height,
+            )
+            # the frame is on disk before the index points at it
+            with open(self._index_path, "ab") as f:
+                f.write(row.tobytes())
+            self._index_stat = _stat(self._index_path)
+            count = len(self._records)
+            if count == len(self._rows):
+                # doubling keeps appends amortized O(1)
+                self._rows = np.concatenate([self._rows, np.zeros(max(count, 1024), RECORD)])
+            self._rows[count] = row[0]
+            self._records = self._rows[: count + 1]
+            self._seqs = self._records["seq"]
+            self._next_seq += 1
+            return key(int(row[0]["seq"]))
+
+    def _row(self, key):
+        seq = int(key[len(KEY_PREFIX) :])
+        i = int(np.searchsorted(self._seqs, seq))
+        if i == len(self._seqs) or self._seqs[i] != seq:
+            raise KeyError(key)
+        return self._records[i]
+
+    def record(self, key):
+        with self._lock:
+            return self._row(key)
+
+    def get(self, key):
+        # The stored bytes as a memoryview over the segment's memory map.
+        with self._lock:
+            row = self._row(key)
+            segment, offset, length = int(row["segment"]), int(row["offset"]), int(row["length"])
+            view = self._maps.get(segment)
+            if view is None or len(view) < offset + length:
+                # the active segment grows; map it again to see the new tail
+                with open(self._segment_path(segment), "rb") as f:
+                    view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self._maps[segment] = view
+            return view[offset : offset + length]
+
+    def between(self, since=None, until=None):
+        # Keys of the frames taken in [since, until], oldest first.
+        with self._lock:
+            times = self._records["time"]
+            start = 0 if since is None else int(np.searchsorted(times, since, "left"))
+            end = len(times) if until is None else int(np.searchsorted(times, until, "right"))
+            return [key(int(seq)) for seq in self._seqs[start:end]]
+
+    def latest(self):
+        with self._lock:
+            return key(int(self._seqs[-1])) if len(self._seqs) else None
+
+    def compact(self, now=None):
+        # Drops the frames the retention policy no longer keeps and packs
+        # the survivors of every segment that lost frames into new
+        # segments. The active segment is left alone. Returns counts.
+        with self._lock:
+            records = self._records
+            if self.retention is None or not len(records):
+                return {"dropped": 0, "rewritten": 0}
+            keep = self.retention.keep(records["time"], time.time() if now is None else now)
+            if self._active is not None:
+                keep |= records["segment"] == self._active
+            touched = np.unique(records["segment"][~keep])
+            if not len(touched):
+                return {"dropped": 0, "rewritten": 0}
+            # sealed segments left under half full by earlier compactions
+            # are merged in as well, so down-sampled history stays in few files
+            sealed = records["segment"] != self._active if self._active is not None else np.ones(len(records), bool)
+            segment_ids, inverse = np.unique(records["segment"][sealed], return_inverse=True)
+            sizes = np.bincount(inverse, weights=records["length"][sealed])
+            small = segment_ids[sizes < self.segment_bytes / 2]
+            if len(small) > 1:
+                touched = np.union1d(touched, small)
+            moving = np.flatnonzero(keep & np.isin(records["segment"], touched))
+            out = records[keep].copy()
+            new_segments = []
+            target, target_file = None, None
+            for i in moving:
+                row = records[i]
+                data = self.get(key(int(row["seq"])))
+                if target_file is None or target_file.tell() + len(data) > self.segment_bytes:
+                    if target_file is not None:
+                        _sync(target_file)
+                    target = self._next_segment
+                    self._next_segment += 1
+                    new_segments.append(target)
+                    target_file = open(self._segment_path(target), "wb")
+                j = int(np.searchsorted(out["seq"], row["seq"]))
+                out["segment"][j] = target
+                out["offset"][j] = target_file.tell()
+                target_file.write(data)
+            if target_file is not None:
+                _sync(target_file)
+            tmp = self._index_path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(out.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self._index_path)
+            self._index_stat = _stat(self._index_path)
+            # readers still holding views keep the unlinked files alive
+            for segment in touched:
+                self._maps.pop(int(segment), None)
+                os.remove(self._segment_path(int(segment)))
+            self._set(out)
+            if self.on_drop is not None:
+                self.on_drop([key(int(seq)) for seq in records["seq"][~keep]])
+            return {"dropped": int(len(records) - len(out)), "rewritten": len(touched)}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "frames": len(self._records),
+                "bytes": int(self._records["length"].sum()),
+                "segments": len(np.unique(self._records["segment"])),
+            }
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
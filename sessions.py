@@ -0,0 +1,69 @@
+import contextvars
+import uuid
+
+import cv2
+import numpy as np
+
+import cache
+import frames
+import governor
+import prefilter
+import watches
+
+
+# The session the current request belongs to. asyncio tasks inherit it;
+# threads get it through contextvars.copy_context(), as tools._in_executor does.
+current = contextvars.ContextVar("session", default=None)
+
+
+class Session:
+    # Per-conversation state, so one process can serve many rooms: the
+    # participant's frames, their watches, cached answers, the LLM context,
+    # where replies are spoken and who is in the room. evaluate is the batched condition checker
+    # handed to the session's WatchScheduler. frame_source defaults to the
+    # latest frame in the session's own buffer.
+    def __init__(self, evaluate, session_id=None, buffer=None, frame_source=None):
+        self.id = session_id or uuid.uuid4().hex[:8]
+        self.buffer = buffer if buffer is not None else frames.FrameBuffer()
+        self._frame_source = frame_source
+        self.participant_id = None
+        self.participants = set()
+        self.context = None
+        # a speech.SpeechSink routed to this session's room; None speaks on
+        # the host (tools.session_speaker)
+        self.speaker = None
+        self.answers = cache.ResponseCache()
+        self.watches = watches.WatchScheduler(
+            evaluate,
+            source=self.current_frame,
+            prefilter=prefilter.for_condition,
+            pace=governor.default.slowdown,
+        )
+
+    def current_frame(self):
+        if self._frame_source is not None:
+            return self._frame_source()
+        frame = self.buffer.latest()
+        if frame is None:
+            raise RuntimeError(f"no video frame yet in session {self.id}")
+        return frame
+
+    def push_image(self, data, size, fmt="RGB"):
+        # Raw video from the transport, converted to the BGR frames the rest
+        # of the pipeline expects.
+        width, height = size
+        image = np.frombuffer(data, np.uint8).reshape(height, width, -1)
+        if fmt == "RGB":
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        elif fmt == "RGBA":
+            image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+        return self.buffer.push(image)
+
+    def activate(self):
+        # Makes this the current session for the calling task; returns the
+        # token for current.reset().
+        return current.set(self)
+
+    async def close(self):
+        await self.watches.close()
+        governor.default.forget(self.id)
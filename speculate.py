@@ -0,0 +1,70 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+
+
+def response_tokens(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return 0
+    return usage.input_tokens + usage.output_tokens
+
+
+class SpendLimiter:
+    # Tracks tokens spent on speculative branches that lost the race, per
+    # branch, and stops speculating once the rolling window is over budget.
+    def __init__(self, max_wasted_tokens=20000, window=60.0):
+        self.max_wasted_tokens = max_wasted_tokens
+        self.window = window
+        self._wasted = deque()
+        self.stats = defaultdict(lambda: {"started": 0, "won": 0, "wasted_tokens": 0})
+
+    def _trim(self, now):
+        while self._wasted and now - self._wasted[0][0] > self.window:
+            self._wasted.popleft()
+
+    def allowed(self):
+        now = time.monotonic()
+        self._trim(now)
+        return sum(tokens for _, tokens in self._wasted) < self.max_wasted_tokens
+
+    def started(self, branch):
+        self.stats[branch]["started"] += 1
+
+    def won(self, branch):
+        self.stats[branch]["won"] += 1
+
+    def wasted(self, branch, tokens):
+        self.stats[branch]["wasted_tokens"] += tokens
+        self._wasted.append((time.monotonic(), tokens))
+
+
+class Speculation:
+    # A set of branches started before the tool is known. take() keeps one
+    # and discards the rest; a branch that already finished is charged its
+    # real usage, one still in flight is cancelled and charged its estimate.
+    def __init__(self, limiter, branches, estimates):
+        self._limiter = limiter
+        self._estimates = estimates
+        self._tasks = {}
+        for name, coro in branches.items():
+            limiter.started(name)
+            self._tasks[name] = asyncio.create_task(coro)
+
+    def __contains__(self, name):
+        return name in self._tasks
+
+    async def take(self, name):
+        task = self._tasks.pop(name)
+        self.discard()
+        self._limiter.won(name)
+        return await task
+
+    def discard(self):
+        for name, task in self._tasks.items():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                self._limiter.wasted(name, response_tokens(task.result()))
+            else:
+                task.cancel()
+                self._limiter.wasted(name, self._estimates.get(name, 0))
+        self._tasks.clear()
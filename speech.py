@@ -0,0 +1,419 @@
+import asyncio
+import contextvars
+import copy
+import hashlib
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+import types
+from collections import OrderedDict
+
+import httpx
+
+import tracing
+
+
+PLAYER = ["mpv", "--no-cache", "--no-terminal", "--", "fd://0"]
+ELEVENLABS_URL = "https://api.elevenlabs.io"
+VOICE_SETTINGS = {"stability": 0.1, "similarity_boost": 0.3, "style": 0.2}
+
+CANNED_PHRASES = [
+    "Hi! Ask me about anything!",
+    "No, I don't remember seeing them.",
+    "Okay, I'll let you know.",
+    "Okay, I've stopped watching.",
+    "I've stopped watching, I didn't see it.",
+]
+
+_SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*\s+")
+_CLAUSE_END = re.compile(r"[,;:]\s+")
+
+_DONE = object()
+
+
+class SentenceChunker:
+    # Cuts streamed text into speakable pieces: at every sentence end, and at
+    # a clause boundary once the pending text is long enough to sound natural.
+    def __init__(self, min_chars=12, clause_chars=80):
+        self.min_chars = min_chars
+        self.clause_chars = clause_chars
+        self._pending = ""
+        self.text = ""
+
+    def push(self, delta):
+        self._pending += delta
+        self.text += delta
+        chunks = []
+        while True:
+            cut = None
+            for match in _SENTENCE_END.finditer(self._pending):
+                if match.end() >= self.min_chars:
+                    cut = match.end()
+                    break
+            if cut is None and len(self._pending) >= self.clause_chars:
+                clauses = list(_CLAUSE_END.finditer(self._pending))
+                if clauses:
+                    cut = clauses[-1].end()
+            if cut is None:
+                return chunks
+            chunks.append(self._pending[:cut].strip())
+            self._pending = self._pending[cut:]
+
+    def flush(self):
+        rest, self._pending = self._pending.strip(), ""
+        return [rest] if rest else []
+
+
+class _Process:
+    # A player command, fed the audio on stdin.
+    def __init__(self, command):
+        self._process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def write(self, audio):
+        self._process.stdin.write(audio)
+        self._process.stdin.flush()
+
+    def close(self):
+        self._process.stdin.close()
+        self._process.wait()
+
+    def kill(self):
+        if self._process.poll() is None:
+            self._process.kill()
+
+
+def _open_player(player):
+    # A player is a command to pipe the audio into, or a callable returning
+    # an object with write(audio), close() (returns once it has played) and
+    # kill().
+    return player() if callable(player) else _Process(player)
+
+
+class Utterance:
+    # One spoken reply. Text chunks passed to say() are synthesized one at a
+    # time in order and their audio is written to a single player, so the
+    # next chunk is synthesized while the previous one plays. cancel() stops
+    # synthesis and kills the player.
+    def __init__(self, synthesize, player=PLAYER):
+        self._synthesize = synthesize
+        self._player = player
+        self._text = queue.Queue()
+        self._audio = queue.Queue(maxsize=256)
+        self._cancelled = threading.Event()
+        self._process = None
+        self._running = 2
+        self._on_finish = []
+        self._lock = threading.Lock()
+        self.spoken = 0
+        # each thread runs in its own copy of the caller's context so spans
+        # are tagged with the request that produced the reply
+        self._threads = [
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._run, self._synthesize_loop),
+                daemon=True,
+            ),
+            threading.Thread(
+                target=contextvars.copy_context().run,
+                args=(self._run, self._play_loop),
+                daemon=True,
+            ),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def say(self, text):
+        if text and not self.cancelled:
+            self.spoken += 1
+            self._text.put(text)
+
+    def finish(self):
+        self._text.put(_DONE)
+
+    def wait(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    async def finished(self):
+        # wait() for the event loop, without holding a thread meanwhile.
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        with self._lock:
+            if not self._running:
+                return
+            self._on_finish.append(done)
+        await future
+
+    def _run(self, loop):
+        try:
+            loop()
+        finally:
+            with self._lock:
+                self._running -= 1
+                callbacks = [] if self._running else self._on_finish
+            for callback in callbacks:
+                callback()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._text.put(_DONE)
+        process = self._process
+        if process is not None:
+            process.kill()
+
+    def _put_audio(self, item):
+        while not self.cancelled:
+            try:
+                self._audio.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _synthesize_loop(self):
+        try:
+            while not self.cancelled:
+                text = self._text.get()
+                if text is _DONE:
+                    break
+                with tracing.span("tts.synthesize", chars=len(text)) as span:
+                    for audio in self._synthesize(text):
+                        if self.cancelled:
+                            break
+                        if audio:
+                            if "ttfb_ms" not in span.attrs:
+                                span.update(
+                                    ttfb_ms=round((time.perf_counter() - span.start) * 1000)
+                                )
+                            self._put_audio(audio)
+        finally:
+            self._put_audio(_DONE)
+
+    def _play_loop(self):
+        first = self._next_audio()
+        if first is _DONE:
+            return
+        to_first_audio = tracing.since_request_start()
+        if to_first_audio is not None:
+            tracing.record("first_audio", to_first_audio)
+        started = time.perf_counter()
+        self._process = _open_player(self._player)
+        if self.cancelled:
+            self._process.kill()
+            return
+        audio = first
+        try:
+            while audio is not _DONE:
+                self._process.write(audio)
+                audio = self._next_audio()
+            self._process.close()
+        except (BrokenPipeError, ValueError):
+            pass
+        tracing.record(
+            "tts.playback", time.perf_counter() - started, cancelled=self.cancelled
+        )
+
+    def _next_audio(self):
+        while not self.cancelled:
+            try:
+                return self._audio.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+
+class SpeechSink:
+    # The single way replies are spoken. It owns one ElevenLabs client on a
+    # pooled keep-alive HTTP connection and caches synthesized audio by a
+    # hash of the text and voice settings, so canned and repeated phrases
+    # play without any synthesis round-trip. Short phrases are kept in a
+    # bounded in-memory LRU; only pinned phrases (the canned ones warm()
+    # synthesizes) are also written to disk, since a streamed reply is cut
+    # into chunks that rarely recur and would grow the directory forever. The
+    # client, and with it the slow elevenlabs import, is only built for the
+    # first phrase that is not cached.
+    def __init__(
+        self,
+        api_key="",
+        voice_id="pMsXgVXv3BLzUgSXRplE",
+        output_format="mp3_22050_32",
+        voice_settings=None,
+        cache_dir="speech_cache",
+        memory_items=256,
+        max_cached_chars=200,
+        base_url=None,
+        player=PLAYER,
+    ):
+        self.api_key = api_key
+        self.voice_id = voice_id
+        self.output_format = output_format
+        # an elevenlabs VoiceSettings; None means VOICE_SETTINGS
+        self.voice_settings = voice_settings
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.max_cached_chars = max_cached_chars
+        self._http = httpx.Client(
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+        )
+        self.base_url = base_url or ELEVENLABS_URL
+        self.player = player
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from elevenlabs import ElevenLabsEnvironment, VoiceSettings
+                    from elevenlabs.client import ElevenLabs
+
+                    if self.voice_settings is None:
+                        self.voice_settings = VoiceSettings(**VOICE_SETTINGS)
+                    # base_url= would force https, which a local stand-in does not speak
+                    environment = ElevenLabsEnvironment(
+                        base=self.base_url, wss=re.sub(r"^http", "ws", self.base_url)
+                    )
+                    self._client = ElevenLabs(
+                        api_key=self.api_key, environment=environment, httpx_client=self._http
+                    )
+        return self._client
+
+    def warm(self, phrases=CANNED_PHRASES):
+        # Build the client and open the TLS connection now rather than on
+        # the first reply, then make sure every canned phrase is cached.
+        self.pin(phrases)
+        self.client
+        try:
+            self._http.head(self.base_url)
+        except httpx.HTTPError as e:
+            print("WARNING: speech warm-up failed: " + repr(e))
+        for phrase in phrases:
+            try:
+                for _ in self.synthesize(phrase):
+                    pass
+            except Exception as e:
+                print("WARNING: could not pre-synthesize " + repr(phrase) + ": " + repr(e))
+
+    def pin(self, phrases):
+        # Phrases whose audio is kept on disk across runs.
+        keys = [self._key(phrase) for phrase in phrases]
+        with self._lock:
+            self._pinned.update(keys)
+
+    def _key(self, text):
+        settings = self.voice_settings or types.SimpleNamespace(**VOICE_SETTINGS)
+        ident = "|".join(
+            [
+                self.voice_id,
+                self.output_format,
+                str(settings.stability),
+                str(settings.similarity_boost),
+                str(settings.style),
+                text.strip(),
+            ]
+        )
+        return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+    def cached(self, text):
+        key = self._key(text)
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                return audio
+        path = os.path.join(self.cache_dir, key + ".mp3")
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+        except FileNotFoundError:
+            return None
+        self._remember(key, audio)
+        return audio
+
+    def _remember(self, key, audio):
+        with self._lock:
+            self._memory[key] = audio
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+
+    def _store(self, key, audio):
+        self._remember(key, audio)
+        with self._lock:
+            if key not in self._pinned:
+                return
+        path = os.path.join(self.cache_dir, key + ".mp3")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, path)
+
+    def synthesize(self, text):
+        # Yields audio bytes for text, from the cache when possible. Audio
+        # fetched from the API is cached only if it was read to the end.
+        cacheable = len(text) <= self.max_cached_chars
+        if cacheable:
+            audio = self.cached(text)
+            if audio is not None:
+                self.hits += 1
+                yield audio
+                return
+        self.misses += 1
+        parts = []
+        client = self.client
+        for part in client.text_to_speech.convert_as_stream(
+            voice_id=self.voice_id,
+            optimize_streaming_latency="0",
+            output_format=self.output_format,
+            text=text,
+            voice_settings=self.voice_settings,
+        ):
+            if cacheable:
+                parts.append(part)
+            yield part
+        if cacheable:
+            self._store(self._key(text), b"".join(parts))
+
+    def routed(self, player, output_format=None):
+        # This sink playing through another player, optionally in another
+        # format (a voice room wants raw PCM for its transport). The client,
+        # connection and caches are shared.
+        sink = copy.copy(self)
+        sink.player = player
+        if output_format is not None:
+            sink.output_format = output_format
+        # canned phrases are pinned per format
+        sink.pin(CANNED_PHRASES)
+        return sink
+
+    def utterance(self):
+        return Utterance(self.synthesize, self.player)
+
+    def say(self, text):
+        utterance = self.utterance()
+        utterance.say(text)
+        utterance.finish()
+        utterance.wait()
@@ -0,0 +1,336 @@
+import collections
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Latency:
+    def __init__(self, mean=0.0, jitter=0.0):
+        self.mean = mean
+        self.jitter = jitter
+
+    def sleep(self):
+        time.sleep(max(0.0, random.gauss(self.mean, self.jitter)))
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.bytes_in = {}
+        self.vlm_calls = 0
+
+    def record(self, route, size, images=0):
+        with self._lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+            self.bytes_in[route] = self.bytes_in.get(route, 0) + size
+            if images:
+                self.vlm_calls += 1
+
+
+class StubServer:
+    # Local stand-in for the Anthropic Messages API and the ElevenLabs
+    # streaming TTS endpoint, with configurable latency and jitter. Replies
+    # are chosen from the system prompt so every tool path gets a plausible
+    # answer; condition checks say yes with probability yes_rate. With rpm,
+    # message requests beyond that many per rolling minute get a 429.
+    def __init__(self, llm=None, tts=None, yes_rate=0.1, seed=0, rpm=None):
+        self.llm = llm or Latency(0.4, 0.1)
+        self.rpm = rpm
+        self._admitted = collections.deque()
+        self.tts = tts or Latency(0.15, 0.05)
+        self.yes_rate = yes_rate
+        self.random = random.Random(seed)
+        self.stats = StubStats()
+        self._cached = set()
+        self._cache_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def admit(self):
+        if self.rpm is None:
+            return True
+        now = time.monotonic()
+        with self._cache_lock:
+            while self._admitted and now - self._admitted[0] > 60:
+                self._admitted.popleft()
+            if len(self._admitted) >= self.rpm:
+                return False
+            self._admitted.append(now)
+            return True
+
+    def usage(self, body, raw, images, text):
+        # Emulates prompt caching: the prefix up to the last cache_control
+        # block is a write the first time it is seen and a read afterwards.
+        usage = {
+            "input_tokens": len(raw) // 4 if not images else 800 * images,
+            "output_tokens": max(1, len(text) // 4),
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+        }
+        prefix = _cached_prefix(body)
+        if prefix:
+            tokens = len(prefix) // 4
+            with self._cache_lock:
+                hit = prefix in self._cached
+                self._cached.add(prefix)
+            usage["cache_read_input_tokens" if hit else "cache_creation_input_tokens"] = tokens
+            usage["input_tokens"] = max(1, usage["input_tokens"] - tokens)
+        return usage
+
+    def reply(self, body):
+        system = body.get("system") or ""
+        if isinstance(system, list):
+            system = " ".join(block.get("text", "") for block in system)
+        text = _user_text(body)
+        if "tool selector" in system:
+            lowered = text.lower()
+            if "tell me when" in lowered or "let me know" in lowered:
+                return "use_loop"
+            if "remember" in lowered or "where did" in lowered:
+                return "recall_previous_image"
+            return "use_current_image"
+        if "keyword extractor" in system:
+            return " ".join(re.findall(r"[a-z]+", text.lower())[-3:])
+        if "stop condition" in system:
+            return "there is a " + text.split()[-1].strip(".?!") + " in the image."
+        if "numbered list of conditions" in system:
+            numbers = re.findall(r"^(\d+)\. ", text, re.MULTILINE)
+            return json.dumps(
+                {
+                    n: (
+                        {"met": True, "description": "Yes, it is on the left."}
+                        if self.random.random() < self.yes_rate
+                        else {"met": False, "description": ""}
+                    )
+                    for n in numbers
+                }
+            )
+        if "condition has been met" in system:
+            return "Yes, I see it." if self.random.random() < self.yes_rate else "No"
+        if "numbered tiles" in system:
+            return "[tile 1, 12:00:00] Yes, I remember. A minute ago they were on the desk next to a blue mug."
+        if "previous image" in system:
+            return "Yes, I remember. They are on the desk next to a blue mug."
+        return "I see a desk with a laptop and a mug. There is a notebook on the left."
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                raw = self.rfile.read(length)
+                path = self.path.split("?")[0]
+                if path == "/v1/messages":
+                    self._messages(raw)
+                elif path.startswith("/v1/text-to-speech/"):
+                    self._tts(raw)
+                else:
+                    self.send_error(404)
+
+            def _messages(self, raw):
+                body = json.loads(raw)
+                if not stub.admit():
+                    stub.stats.record("rate_limited", len(raw))
+                    payload = json.dumps(
+                        {
+                            "type": "error",
+                            "error": {"type": "rate_limit_error", "message": "stub rpm"},
+                        }
+                    ).encode()
+                    self.send_response(429)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.send_header("retry-after", "1")
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                images = _count_images(body)
+                stub.stats.record("messages", len(raw), images)
+                stub.llm.sleep()
+                text = stub.reply(body)
+                usage = stub.usage(body, raw, images, text)
+                if body.get("stream"):
+                    self._stream_message(text, usage)
+                    return
+                payload = json.dumps(
+                    {
+                        "id": "msg_stub",
+                        "type": "message",
+                        "role": "assistant",
+                        "model": body.get("model"),
+                        "content": [{"type": "text", "text": text}],
+                        "stop_reason": "end_turn",
+                        "stop_sequence": None,
+                        "usage": usage,
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _event(self, name, data):
+                chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.flush()
+
+            def _stream_message(self, text, usage):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self._event(
+                    "message_start",
+                    {
+                        "type": "message_start",
+                        "message": {
+                            "id": "msg_stub",
+                            "type": "message",
+                            "role": "assistant",
+                            "model": "stub",
+                            "content": [],
+                            "stop_reason": None,
+                            "stop_sequence": None,
+                            "usage": dict(usage, output_tokens=1),
+                        },
+                    },
+                )
+                self._event(
+                    "content_block_start",
+                    {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                )
+                for word in re.findall(r"\S+\s*", text):
+                    time.sleep(0.01)
+                    self._event(
+                        "content_block_delta",
+                        {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word}},
+                    )
+                self._event("content_block_stop", {"type": "content_block_stop", "index": 0})
+                self._event(
+                    "message_delta",
+                    {
+                        "type": "message_delta",
+                        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                        "usage": {"output_tokens": usage["output_tokens"]},
+                    },
+                )
+                self._event("message_stop", {"type": "message_stop"})
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _tts(self, raw):
+                body = json.loads(raw or b"{}")
+                stub.stats.record("tts", len(raw))
+                stub.tts.sleep()
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/mpeg")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                # roughly 1 KB of audio per 15 characters
+                for _ in range(max(1, len(body.get("text", "")) // 15)):
+                    chunk = b"\0" * 1024
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+
+def _user_text(body):
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get("text", "") for block in content if block.get("type") == "text")
+    return "\n".join(parts)
+
+
+def _cached_prefix(body):
+    blocks = body.get("system") or []
+    if isinstance(blocks, str):
+        blocks = [{"type": "text", "text": blocks}]
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        blocks = blocks + content
+    end = max((i + 1 for i, block in enumerate(blocks) if block.get("cache_control")), default=0)
+    return json.dumps(blocks[:end]) if end else ""
+
+
+def _count_images(body):
+    return sum(
+        1
+        for message in body.get("messages", [])
+        if not isinstance(message.get("content"), str)
+        for block in message["content"]
+        if block.get("type") == "image"
+    )
+
+
+def install_dbutils(frame_dir, latency=None):
+    # Registers an in-process dbutils stand-in. store_frame saves the image
+    # under frame_dir; search returns the most recently stored frame.
+    latency = latency or Latency(0.05, 0.01)
+    os.makedirs(frame_dir, exist_ok=True)
+    module = types.ModuleType("dbutils")
+    stored = []
+    lock = threading.Lock()
+
+    def store_frame(img, frame_counter):
+        latency.sleep()
+        path = os.path.join(frame_dir, f"{frame_counter}.jpeg")
+        img.save(path, "JPEG")
+        with lock:
+            stored.append(path)
+
+    def search(keywords):
+        latency.sleep()
+        with lock:
+            if not stored:
+                raise RuntimeError("no frames stored yet")
+            return stored[-1]
+
+    def getResponse(filename, user_query):
+        latency.sleep()
+        return "Yes, I remember. They are on the desk next to a blue mug."
+
+    module.store_frame = store_frame
+    module.search = search
+    module.getResponse = getResponse
+    module.stored = stored
+    sys.modules["dbutils"] = module
+    return module
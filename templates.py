@@ -0,0 +1,31 @@
+MODEL = "claude-3-haiku-20240307"
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+def cached_text(text):
+    # A text block that ends a cacheable prefix: everything up to and
+    # including it is written to the prompt cache and read back by later
+    # requests that start the same way.
+    return {"type": "text", "text": text, "cache_control": EPHEMERAL}
+
+
+class RequestTemplate:
+    # The fixed part of a Messages API request, built once per prompt. The
+    # system prompt is a cache breakpoint, so repeated calls read it from
+    # Anthropic's prompt cache instead of reprocessing it. Prefixes shorter
+    # than the model's minimum cacheable length are simply not cached.
+    def __init__(self, system, model=MODEL, max_tokens=1024):
+        self.system = [cached_text(system)]
+        self._fixed = {"model": model, "max_tokens": max_tokens, "system": self.system}
+
+    def build(self, *content):
+        # content is a single string, or strings and content blocks in order.
+        if len(content) == 1 and isinstance(content[0], str):
+            content = content[0]
+        else:
+            content = [
+                {"type": "text", "text": part} if isinstance(part, str) else part
+                for part in content
+            ]
+        return {**self._fixed, "messages": [{"role": "user", "content": content}]}
@@ -1,24 +1,100 @@
-import base64
+import asyncio
+import capture
+import json
+import contextvars
 import cv2
 import dbutils
-from PIL import Image
+import embeddings
+import frames
+import governor
+import imageprep
+import ingest
+import os
+import prefilter
+import re
+import itertools
+import numpy as np
+import sys
+import router
+import scene
+import segments
+import sessions
+import speculate
+import speech
+import templates
+import tracing
+import vindex
 import threading
-import anthropic
 import time
-from cartesia import Cartesia
-from elevenlabs import play, VoiceSettings, stream
-from elevenlabs.client import ElevenLabs
+from concurrent.futures import ThreadPoolExecutor
 
 
-client = anthropic.Anthropic()
-voice = ElevenLabs(api_key="")
+# The API clients and the speaker are built on first use (see get_client,
+# get_aclient, get_speaker): importing anthropic and elevenlabs takes longer
+# than everything else here, and warm_up can do it before anyone asks.
+_client = None
+_aclient = None
+_speaker = None
+_clients_lock = threading.Lock()
+tool_router = router.Router()
+speculation_limiter = speculate.SpendLimiter()
 
+# Blocking work (database search, file reads, image encoding) run from the
+# async tool layer goes through this pool so it never stalls the event loop.
+# Every session in the process shares it, so nothing waits on playback here.
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TOOL_WORKERS", "4")), thread_name_prefix="tools"
+)
 
-def get_tool(user_query: str):
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=1024,
-        system="""You're a tool selector tool that finds the best tool for the user query. You should return the name of the tool that should be used for the user query. The tools available are: use_current_image, recall_previous_image, use_loop.
+def get_client():
+    global _client
+    if _client is None:
+        with _clients_lock:
+            if _client is None:
+                import anthropic
+
+                # Retries are left to the governor, which has to see every
+                # 429 to back off.
+                _client = anthropic.Anthropic(max_retries=0)
+    return _client
+
+
+def get_aclient():
+    global _aclient
+    if _aclient is None:
+        with _clients_lock:
+            if _aclient is None:
+                import anthropic
+
+                _aclient = anthropic.AsyncAnthropic(max_retries=0)
+    return _aclient
+
+
+def get_speaker():
+    # The process's speaker, playing on this host. A voice room gives its
+    # session a routed copy instead (see session_speaker).
+    global _speaker
+    if _speaker is None:
+        with _clients_lock:
+            if _speaker is None:
+                _speaker = speech.SpeechSink(api_key="")
+    return _speaker
+
+
+def set_speaker(sink):
+    global _speaker
+    _speaker = sink
+
+
+def __getattr__(name):
+    # tools.client, tools.aclient and tools.speaker for other modules
+    accessors = {"client": get_client, "aclient": get_aclient, "speaker": get_speaker}
+    if name in accessors:
+        return accessors[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+TOOL_SELECTOR_PROMPT = """You're a tool selector tool that finds the best tool for the user query. You should return the name of the tool that should be used for the user query. The tools available are: use_current_image, recall_previous_image, use_loop.
         
         - The use_current_image tool should be used when the user query is asking about a visual task that can be answered with the current image in the present. For example, "What do you see in front of you?", or "Solve this equation", or "What is the color of the object in front of you?".
         - The recall_previous_image tool should be used when the user query is asking about a visual task that can be answered with the previous image. For example, "I can't find my keys, do you remember where I left them?", or "What color was the triangle from the image I just showed you?".
@@ -27,54 +103,11 @@ def get_tool(user_query: str):
 
         Return the use_loop tool if the user needs to wait for you to find something in the image. For example, return the use_loop tool if the user says "Tell me when you see a blue pen"
         
-        Remember to only return the name of the tool that should be used, and nothing else. Return the exact name of the tool. You must return either use_current_image, recall_previous_image, or use_loop.""",
-        messages=[
-            {
-                "role": "user",
-                "content": f"""Which tool should be used for the user query? user query: {user_query}
-             """,
-            }
-        ],
-    )
-    return response.content[0].text
-
-
-def use_current_image(user_query: str):
-    with open("latest.jpeg", "rb") as image_file:
-        image_data = image_file.read()
-
-    base64_image = base64.b64encode(image_data).decode("utf-8")
-
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=1024,
-        system="""You're a helpful assistant that processes the user query using the current image. You should return the answer to the user query based on the current image. Do not mention the image or mention that you are looking at an image. Simply respond as if you were a real person, and the image is your eyesight. Be brief and respond with two sentences at most. Remember, do not mention the image or that you are looking at an image. Instead, say "I see..." or "I notice...".""",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": base64_image,
-                        },
-                    },
-                    {"type": "text", "text": f"User query: {user_query}"},
-                ],
-            }
-        ],
-    )
-
-    return response.content[0].text
+        Remember to only return the name of the tool that should be used, and nothing else. Return the exact name of the tool. You must return either use_current_image, recall_previous_image, or use_loop."""
 
+CURRENT_IMAGE_PROMPT = """You're a helpful assistant that processes the user query using the current image. You should return the answer to the user query based on the current image. Do not mention the image or mention that you are looking at an image. Simply respond as if you were a real person, and the image is your eyesight. Be brief and respond with two sentences at most. Remember, do not mention the image or that you are looking at an image. Instead, say "I see..." or "I notice..."."""
 
-def use_loop(user_query: str):
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=1024,
-        system="""You analyze user requests to describe what to detect in an image. You must return what the stop condition is for an agentic AI loop.
+STOP_CONDITION_PROMPT = """You analyze user requests to describe what to detect in an image. You must return what the stop condition is for an agentic AI loop.
              Your job is only to determine what the condition is that the AI should look for in an image.
              DO NOT RETURN ANYTHING, EXCEPT FOR THE STOP CONDITION. ONLY RESPOND WITH THE STOP CONDITION AND NOTHING ELSE.
              THE STOP CONDITION MUST BE A STATEMENT THAT CAN BE EITHER TRUE OR FALSE BASED ON AN IMAGE.
@@ -85,29 +118,9 @@ def use_loop(user_query: str):
              EXAMPLE USER INPUT: "find a cat"
              EXAMPLE OUTPUT: "a cat is in this image."
              
-             Remember, you must only return the stop condition based on the user query. Do not return anything else.""",
-        messages=[
-            {
-                "role": "user",
-                "content": f"User query: {user_query}",
-            }
-        ],
-    )
-
-    stop_condition = response.content[0].text
-    print("INFO: stop condition: " + stop_condition)
-
-    while True:
-        print("new")
-        with open("latest.jpeg", "rb") as image_file:
-            image_data = image_file.read()
-
-        base64_image = base64.b64encode(image_data).decode("utf-8")
+             Remember, you must only return the stop condition based on the user query. Do not return anything else."""
 
-        response = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=1024,
-            system="""You are analyzing an image. You must answer if a condition has been met or not within the supplied image.
+CONDITION_CHECK_PROMPT = """You are analyzing an image. You must answer if a condition has been met or not within the supplied image.
             Based on the objects or characteristics in the image, respond with "Yes" or "No". If you respond with "Yes", you must
             also describe what the condition is that has been met and where it is in the image. Otherwise, only respond with "No" and
             nothing else.
@@ -119,78 +132,585 @@ def use_loop(user_query: str):
             EXAMPLE USER INPUT: "there is a cat in the image"
             If you see a cat in the image, you should respond with something like "Yes, there is a cat in the image. It is sitting on a chair."
             If you do not see a cat in the image, you should respond with "No".
-            """,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": f"condition: {stop_condition}"},
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "image/jpeg",
-                                "data": base64_image,
-                            },
-                        },
-                    ],
-                }
-            ],
+            """
+
+KEYWORD_PROMPT = "you're a keyword extractor tool that finds keywords from user input that will be used in searching a vector database. extract the relevant keywords into one string from the user's request. Only return the string itself, do not return anything else. Do not include any punctuation in the string or any symbols. Only include words that will be useful for searching the database for that image. For example, if the user says 'I haven't seen my keys in a while. They are blue and shiny', you should return 'blue shiny keys'"
+
+WATCH_PROMPT = """You are analyzing an image. You are given a numbered list of conditions, and you must decide for each one whether it has been met within the supplied image.
+
+Respond only with a JSON object that has one entry per condition number. Each entry is an object with "met" set to true or false, and "description". If the condition is met, the description must start with "Yes," and briefly describe what has been met and where it is in the image, in two sentences at most. Otherwise the description is an empty string.
+
+EXAMPLE CONDITIONS:
+1. there is a blue object in the image
+2. there is a cat in the image
+EXAMPLE OUTPUT IF ONLY A BLUE WATER BOTTLE IS VISIBLE:
+{"1": {"met": true, "description": "Yes, there is a blue object in the image. It appears to be a blue water bottle on a desk next to a notebook."}, "2": {"met": false, "description": ""}}
+
+Do not return anything except the JSON object."""
+
+RECALL_PROMPT = """You're a tool that processes the user query using a previous image. You should return the answer to the user query based on the previous image. Do not mention the image or mention that you are looking at an image. Simply respond as if you were a real person, and the image is your eyesight. Be brief and respond with two sentences at most. Remember, do not mention the image or that you are looking at an image. Instead, say "I saw..." or "Yes, I remember...". Do not mention the image at all.
+        
+        EXAMPLE USER INPUT: "I haven't see my glasses recently, do you know where they are?"
+        EXAMPLE OUTPUT IF SEEN: "Yes, I remember. They are on the table in the living room, next to a blue mug."
+        EXAMPLE OUTPUT IF NOT SEEN: "No, I don't remember seeing them."
+        """
+
+RECALL_GRID_PROMPT = """You're a tool that processes the user query using several previous images. You are given one picture made of numbered tiles; each tile is a moment you saw in the past, labeled in its top-left corner with its number and the time it was seen. Tiles are ordered by how well they match the query, best first. Answer the user query based on the tiles.
+
+Start your answer with the tile you used and its time in square brackets, like [tile 2, 14:03:22], then answer as if you were a real person and the tiles were your memory. Mention when you saw it, for example "about ten minutes ago" or "at 2 PM", using the current time you are given. Do not mention images or tiles after the brackets. Be brief and respond with two sentences at most.
+
+EXAMPLE USER INPUT: "I haven't see my glasses recently, do you know where they are?"
+EXAMPLE OUTPUT IF SEEN: "[tile 3, 14:03:22] Yes, I remember. About ten minutes ago they were on the table in the living room, next to a blue mug."
+EXAMPLE OUTPUT IF NOT SEEN: "[none] No, I don't remember seeing them."
+"""
+
+
+# Watches outlive the request that started them; this cancels them.
+STOP_WATCHING = re.compile(r"\b(stop|quit|cancel) (watching|looking|waiting)\b|\bcancel (the|my|all) watch")
+WATCH_STARTED = "Okay, I'll let you know."
+WATCH_STOPPED = "Okay, I've stopped watching."
+WATCH_EXPIRED = "I've stopped watching, I didn't see it."
+# seconds a watch keeps looking before it gives up and says so
+WATCH_TIMEOUT = float(os.getenv("WATCH_TIMEOUT", "600"))
+
+TOOL_TEMPLATE = templates.RequestTemplate(TOOL_SELECTOR_PROMPT)
+CURRENT_IMAGE_TEMPLATE = templates.RequestTemplate(CURRENT_IMAGE_PROMPT)
+STOP_CONDITION_TEMPLATE = templates.RequestTemplate(STOP_CONDITION_PROMPT)
+CONDITION_CHECK_TEMPLATE = templates.RequestTemplate(CONDITION_CHECK_PROMPT)
+WATCH_TEMPLATE = templates.RequestTemplate(WATCH_PROMPT)
+KEYWORD_TEMPLATE = templates.RequestTemplate(KEYWORD_PROMPT)
+RECALL_TEMPLATE = templates.RequestTemplate(RECALL_PROMPT)
+RECALL_GRID_TEMPLATE = templates.RequestTemplate(RECALL_GRID_PROMPT)
+
+
+def _tool_request(user_query):
+    return TOOL_TEMPLATE.build(
+        f"Which tool should be used for the user query? user query: {user_query}"
+    )
+
+
+def _current_image_request(user_query, image):
+    return CURRENT_IMAGE_TEMPLATE.build(image.block, f"User query: {user_query}")
+
+
+def _stop_condition_request(user_query):
+    return STOP_CONDITION_TEMPLATE.build(f"User query: {user_query}")
+
+
+def _condition_check_request(stop_condition, image):
+    # The condition stays the same for every poll of a use_loop, so it is
+    # cached along with the system prompt and only the image is new.
+    return CONDITION_CHECK_TEMPLATE.build(
+        templates.cached_text(f"condition: {stop_condition}"), image.block
+    )
+
+
+def _watch_request(conditions, image):
+    listing = "\n".join(f"{number}. {condition}" for number, condition in conditions)
+    return WATCH_TEMPLATE.build(
+        templates.cached_text(f"conditions:\n{listing}"), image.block
+    )
+
+
+def _parse_watch_response(text):
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end == -1:
+        return {}
+    try:
+        results = json.loads(text[start : end + 1])
+    except json.JSONDecodeError:
+        return {}
+    met = {}
+    for number, result in results.items():
+        if isinstance(result, dict) and result.get("met") is True:
+            met[int(number)] = result.get("description") or "Yes."
+    return met
+
+
+def _keywords_request(query_string):
+    return KEYWORD_TEMPLATE.build("User input: " + query_string)
+
+
+def _recall_request(query_string, image):
+    return RECALL_TEMPLATE.build(image.block, f"User query: {query_string}")
+
+
+def _recall_grid_request(query_string, image):
+    now = time.strftime("%H:%M:%S")
+    return RECALL_GRID_TEMPLATE.build(
+        image.block, f"Current time: {now}\nUser query: {query_string}"
+    )
+
+
+_CITATION = re.compile(r"^\s*\[[^\]]*\]\s*")
+
+
+class _Uncited:
+    # Speaks through an utterance, minus the leading "[tile N, time]"
+    # citation of a grid recall answer.
+    def __init__(self, utterance):
+        self._utterance = utterance
+        self._first = True
+
+    def say(self, text):
+        if self._first:
+            self._first = False
+            text = _CITATION.sub("", text, count=1)
+        if text:
+            self._utterance.say(text)
+
+    def __getattr__(self, name):
+        return getattr(self._utterance, name)
+
+
+# Governor priority class per call name; anything else is interactive.
+PRIORITIES = {
+    "keywords": governor.RECALL,
+    "recall": governor.RECALL,
+    "recall_grid": governor.RECALL,
+    "condition_check": governor.WATCH,
+    "watch": governor.WATCH,
+}
+# Retries wait out the governor's backoff, so a rate-limited poll is
+# simply late; after that it gives up until a later frame.
+RETRIES = {governor.INTERACTIVE: 4, governor.RECALL: 3, governor.WATCH: 2}
+
+
+def _create(name, request):
+    priority = PRIORITIES.get(name, governor.INTERACTIVE)
+    with tracing.span("llm." + name, priority=governor.NAMES[priority]) as span:
+        response = governor.default.call(
+            lambda: get_client().messages.create(**request),
+            priority,
+            governor.estimate_tokens(request),
+            session().id,
+            key=governor.request_key(request),
+            retries=RETRIES[priority],
+        )
+        span.usage(response)
+    return response
+
+
+def select_tool(user_query: str):
+    response = _create("tool", _tool_request(user_query))
+    return response.content[0].text
+
+
+def get_tool(user_query: str):
+    with tracing.span("get_tool") as span:
+        tool = tool_router.route(user_query, select_tool)
+        span.update(tool=tool)
+    return tool
+
+
+class _Stream:
+    # One streamed reply, shared by _complete and _acomplete: each sentence
+    # goes to the utterance as soon as it is complete, and the request is
+    # retried on a failure the governor recognizes while nothing has been
+    # spoken yet. Used as "with stream:", each attempt inside running in a
+    # "with attempt:" block.
+    def __init__(self, name, request, utterance):
+        self.utterance = utterance
+        self.priority = PRIORITIES.get(name, governor.INTERACTIVE)
+        self.tokens = governor.estimate_tokens(request)
+        self.chunker = speech.SentenceChunker()
+        self._tracing = tracing.span(
+            "llm." + name, stream=True, priority=governor.NAMES[self.priority]
+        )
+        self.span = None
+
+    def __enter__(self):
+        self.span = self._tracing.__enter__()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if error is None:
+            for chunk in self.chunker.flush():
+                self.utterance.say(chunk)
+        return self._tracing.__exit__(kind, error, traceback)
+
+    def attempts(self):
+        for number in itertools.count():
+            attempt = _Attempt(self, number)
+            yield attempt
+            if not attempt.failed:
+                return
+
+    def push(self, delta):
+        if "first_token_ms" not in self.span.attrs:
+            self.span.update(
+                first_token_ms=round((time.perf_counter() - self.span.start) * 1000)
+            )
+        for chunk in self.chunker.push(delta):
+            self.utterance.say(chunk)
+
+    def finish(self, message, grant):
+        self.span.usage(message)
+        grant.release(governor.response_tokens(message))
+
+    @property
+    def text(self):
+        return self.chunker.text
+
+
+class _Attempt:
+    def __init__(self, stream, number):
+        self.stream = stream
+        self.number = number
+        self.failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        if not isinstance(error, Exception):
+            return False
+        self.failed = not (
+            self.stream.text
+            or governor.failure(error) is None
+            or self.number >= RETRIES[self.stream.priority]
         )
+        return self.failed
+
+
+def _complete(name, request, utterance=None):
+    # With an utterance, stream the reply and hand each sentence to TTS as
+    # soon as it is complete.
+    if utterance is None:
+        return _create(name, request).content[0].text
+    with _Stream(name, request, utterance) as stream:
+        for attempt in stream.attempts():
+            with attempt, governor.default.slot(
+                stream.priority, stream.tokens, session().id
+            ) as grant:
+                with get_client().messages.stream(**request) as response:
+                    for delta in response.text_stream:
+                        stream.push(delta)
+                        if utterance.cancelled:
+                            break
+                    else:
+                        stream.finish(response.get_final_message(), grant)
+    return stream.text
+
+
+def use_current_image(user_query: str, utterance=None):
+    with tracing.span("frame"):
+        frame = session().current_frame()
+    cached = session().answers.get(frame, user_query)
+    if cached is not None:
+        return cached
+    image = imageprep.prepare(frame, "use_current_image", user_query)
+
+    answer = _complete(
+        "current_image", _current_image_request(user_query, image), utterance
+    )
+
+    session().answers.put(frame, user_query, answer)
+    return answer
+
+
+def use_loop(user_query: str):
+    response = _create("stop_condition", _stop_condition_request(user_query))
+
+    stop_condition = response.content[0].text
+    print("INFO: stop condition: " + stop_condition)
+
+    # Conditions the CPU can screen for are checked on every frame and only
+    # candidates go to the VLM; anything else is polled through the gate.
+    tier1 = prefilter.for_condition(stop_condition)
+    gate = scene.ChangeGate()
+    deadline = time.monotonic() + WATCH_TIMEOUT
+    while True:
+        if time.monotonic() > deadline:
+            print("INFO: watch expired: " + stop_condition)
+            return WATCH_EXPIRED
+        frame = session().current_frame()
+        if tier1 is not None:
+            if not tier1.should_escalate(frame):
+                time.sleep(0.03)
+                continue
+        elif not gate.should_check(frame):
+            time.sleep(0.2)
+            continue
+        print("new")
+        image = imageprep.prepare(frame, "use_loop", stop_condition)
+
+        try:
+            response = _create(
+                "condition_check", _condition_check_request(stop_condition, image)
+            )
+        except Exception as e:
+            if governor.failure(e) is None:
+                raise
+            print("INFO: condition check failed, waiting for a later frame: " + repr(e))
+            time.sleep(governor.default.slowdown())
+            continue
         print(response.content[0].text)
         if "Yes" in response.content[0].text:
             return response.content[0].text
-        time.sleep(1)
+        if tier1 is None:
+            # polls less often while the governor is under pressure
+            time.sleep(governor.default.slowdown())
 
 
-def use_recall(query_string):
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=1024,
-        system="you're a keyword extractor tool that finds keywords from user input that will be used in searching a vector database. extract the relevant keywords into one string from the user's request. Only return the string itself, do not return anything else. Do not include any punctuation in the string or any symbols. Only include words that will be useful for searching the database for that image. For example, if the user says 'I haven't seen my keys in a while. They are blue and shiny', you should return 'blue shiny keys'",
-        messages=[
-            {"role": "user", "content": "User input: " + query_string},
-        ],
-    )
+def use_recall(query_string, utterance=None):
+    response = _create("keywords", _keywords_request(query_string))
     keywords = response.content[0].text
     print("INFO: keywords: " + keywords)
 
-    img_path = dbutils.search(keywords)
-    print("INFO: image path: " + img_path)
+    frame = None
+    if RECALL_FRAMES > 1:
+        recalled = recall_frames(keywords)
+        if len(recalled) > 1:
+            image = recall_grid(recalled, query_string)
+            answer = _complete(
+                "recall_grid",
+                _recall_grid_request(query_string, image),
+                utterance and _Uncited(utterance),
+            )
+            print("INFO: recall answer: " + answer)
+            return answer
+        # a lone match is sent on its own, not as a small grid tile
+        frame = recalled[0] if recalled else None
 
-    with open(img_path, "rb") as image_file:
-        image_data = image_file.read()
+    if frame is None:
+        key = find_memory(keywords)
+        frame = _load_remembered(key)
+        if frame is None:
+            return NOT_REMEMBERED
+        print("INFO: image path: " + key)
 
-    base64_image = base64.b64encode(image_data).decode("utf-8")
+    # the stored encoding, whatever the query: a remembered frame has no
+    # more detail than it was stored with
+    image = imageprep.prepare(frame, "use_recall")
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=1024,
-        system="""You're a tool that processes the user query using a previous image. You should return the answer to the user query based on the previous image. Do not mention the image or mention that you are looking at an image. Simply respond as if you were a real person, and the image is your eyesight. Be brief and respond with two sentences at most. Remember, do not mention the image or that you are looking at an image. Instead, say "I saw..." or "Yes, I remember...". Do not mention the image at all.
-        
-        EXAMPLE USER INPUT: "I haven't see my glasses recently, do you know where they are?"
-        EXAMPLE OUTPUT IF SEEN: "Yes, I remember. They are on the table in the living room, next to a blue mug."
-        EXAMPLE OUTPUT IF NOT SEEN: "No, I don't remember seeing them."
-        """,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": base64_image,
-                        },
-                    },
-                    {"type": "text", "text": f"User query: {query_string}"},
-                ],
-            }
-        ],
+    return _complete("recall", _recall_request(query_string, image), utterance)
+
+
+MEMORY_DIR = "memory"
+# Every frame for the last hour, one a minute for the day, one every ten
+# minutes for a month.
+MEMORY_RETENTION = segments.Retention()
+
+# The answer when no remembered frame matches or can still be loaded.
+NOT_REMEMBERED = "No, I don't remember seeing them."
+# Hits find_memory looks through for one the retention policy kept.
+RECALL_CANDIDATES = 8
+
+_memory_index = None
+_memory_store = None
+_memory_lock = threading.Lock()
+
+
+def memory_store():
+    global _memory_store
+    if _memory_store is None:
+        with _memory_lock:
+            if _memory_store is None:
+                _memory_store = segments.SegmentStore(
+                    os.path.join(MEMORY_DIR, "segments"),
+                    retention=MEMORY_RETENTION,
+                    on_drop=_forget_memories,
+                )
+    return _memory_store
+
+
+def _forget_memories(keys):
+    # Compacted frames leave the recall index too, so searches stop
+    # returning keys that no longer load.
+    index = memory_index()
+    if index is not None:
+        forgotten = index.remove(keys)
+        print(f"INFO: forgot {forgotten} compacted frames")
+
+
+def memory_index():
+    # The local recall index needs a CLIP model to embed frames and queries;
+    # without one, recall goes through dbutils.search only.
+    global _memory_index
+    if _memory_index is None and embeddings.available():
+        with _memory_lock:
+            if _memory_index is None:
+                _memory_index = vindex.VectorIndex(
+                    os.path.join(MEMORY_DIR, "index"), embeddings.DIM
+                )
+    return _memory_index
+
+
+def store_frame(frame, frame_counter):
+    # Each frame goes to one place, the one recall searches: the segment
+    # store and its local index when there is a CLIP model, otherwise
+    # dbutils, which writes a file per frame.
+    from PIL import Image
+
+    img = Image.fromarray(cv2.cvtColor(frame.image, cv2.COLOR_BGR2RGB))
+    index = memory_index()
+    if index is None:
+        dbutils.store_frame(img, frame_counter)
+        return
+
+    # kept in the recall encoding, so a recalled frame is sent as stored
+    image = imageprep.encoded(frame, "use_recall")
+    key = memory_store().append(
+        image.data, frame.timestamp, image.width, image.height, frame.fingerprint
     )
+    index.add(embeddings.image(img), key, frame.timestamp)
 
-    return response.content[0].text
+
+def load_memory(key):
+    # A remembered frame: a zero-copy view into the segment store, or a file
+    # for dbutils results and memories written before the store existed.
+    store = memory_store()
+    if not store.owns(key):
+        return frames.load(key)
+    store.refresh()
+    with tracing.span("memory.load"):
+        row = store.record(key)
+        frame = frames.Frame(
+            int(row["seq"]),
+            float(row["time"]),
+            jpeg=store.get(key),
+            fingerprint=int(row["fingerprint"]),
+        )
+        imageprep.adopt(frame, "use_recall", int(row["width"]), int(row["height"]))
+    return frame
+
+
+def search_memory_hits(keywords, k=1, since=None, until=None):
+    # Returns up to k vindex.Hit, best match first. dbutils only ever finds
+    # one frame, timed by its file when it is local.
+    with tracing.span("search", k=k) as span:
+        index = memory_index()
+        if index is not None:
+            index.refresh()
+            if len(index):
+                hits = index.search(embeddings.text(keywords), k, since, until)
+                if hits:
+                    span.update(source="local", hits=len(hits))
+                    return hits
+        span.update(source="dbutils")
+        path = dbutils.search(keywords)
+        timestamp = os.path.getmtime(path) if os.path.exists(path) else None
+        return [vindex.Hit(path, 0.0, timestamp)]
+
+
+def search_memory(keywords, k=1, since=None, until=None):
+    # Returns up to k memory keys (see load_memory), best match first.
+    return [hit.key for hit in search_memory_hits(keywords, k, since, until)]
+
+
+def _remembered(key):
+    # False for a store key compacted away since it was indexed.
+    store = memory_store()
+    if not store.owns(key):
+        return True
+    store.refresh()
+    try:
+        store.record(key)
+    except KeyError:
+        return False
+    return True
+
+
+def find_memory(keywords, k=RECALL_CANDIDATES):
+    # The best-matching memory key that can still be loaded, or None.
+    # Compaction tombstones what it drops in this process's index, but one
+    # run elsewhere is only seen here later, so a few hits are walked.
+    for key in search_memory(keywords, k):
+        if _remembered(key):
+            return key
+    print("INFO: nothing remembered for " + keywords)
+    return None
+
+
+def _load_remembered(key):
+    # load_memory, or None when key is None or was compacted meanwhile.
+    if key is None:
+        return None
+    try:
+        return load_memory(key)
+    except (OSError, KeyError) as e:
+        print("INFO: memory gone before it was loaded: " + repr(e))
+        return None
+
+
+# Frames tiled into one image for a recall; 1 sends the single best match.
+RECALL_FRAMES = int(os.getenv("RECALL_FRAMES", "4"))
+RECALL_DUPLICATE_DISTANCE = 6
+
+
+def recall_frames(keywords, k=RECALL_FRAMES):
+    # The k best remembered frames, skipping near-duplicates of a better
+    # match (the same scene stored again while nothing moved).
+    with tracing.span("recall_frames", k=k) as span:
+        hits = search_memory_hits(keywords, k * 2)
+        recalled = []
+        for hit in hits:
+            try:
+                frame = load_memory(hit.key)
+            except (OSError, KeyError):
+                # compacted away by the retention policy
+                continue
+            if hit.timestamp is not None:
+                frame.timestamp = hit.timestamp
+            if any(
+                scene.hamming(frame.fingerprint, other.fingerprint) <= RECALL_DUPLICATE_DISTANCE
+                for other in recalled
+            ):
+                continue
+            recalled.append(frame)
+            if len(recalled) == k:
+                break
+        span.update(candidates=len(hits), kept=len(recalled))
+    return recalled
+
+
+def recall_grid(recalled, query_string):
+    labels = [
+        f"{i} {time.strftime('%H:%M:%S', time.localtime(frame.timestamp))}"
+        for i, frame in enumerate(recalled, 1)
+    ]
+    grid = imageprep.composite([frame.image for frame in recalled], labels)
+    return imageprep.prepare(
+        frames.Frame(0, time.time(), image=grid), "use_recall_grid", query_string
+    )
+
+
+def run_tool(user_input, utterance=None):
+    tool = get_tool(user_input)
+    print("INFO: using tool " + tool)
+    if "use_current_image" in tool:
+        with tracing.span("tool.use_current_image"):
+            return use_current_image(user_input, utterance)
+    elif "use_loop" in tool:
+        with tracing.span("tool.use_loop"):
+            return use_loop(user_input)
+    elif "recall_previous_image" in tool:
+        with tracing.span("tool.recall_previous_image"):
+            return use_recall(user_input, utterance)
+    return None
+
+
+def speak(text):
+    session_speaker().say(text)
+
+
+def session_speaker():
+    # Where the current session's replies are spoken: its room's transport
+    # when it has one, the host otherwise.
+    return session().speaker or get_speaker()
+
+
+async def asay(text, speaker=None):
+    # speak() for the event loop; playback does not hold a pool thread.
+    utterance = (speaker or session_speaker()).utterance()
+    try:
+        utterance.say(text)
+        utterance.finish()
+        await utterance.finished()
+    except BaseException:
+        utterance.cancel()
+        raise
 
 
 def get_user_input():
@@ -199,105 +719,585 @@ def get_user_input():
         if user_input == "exit":
             break
 
-        tool = get_tool(user_input)
-        print("INFO: using tool " + tool)
-        if "use_current_image" in tool:
-            response = use_current_image(user_input)
-            print(response)
-            res = voice.text_to_speech.convert_as_stream(
-                voice_id="pMsXgVXv3BLzUgSXRplE",
-                optimize_streaming_latency="0",
-                output_format="mp3_22050_32",
-                text=response,
-                voice_settings=VoiceSettings(
-                    stability=0.1,
-                    similarity_boost=0.3,
-                    style=0.2,
-                ),
-            )
-            stream(res)
-            # play(res)
-        elif "use_loop" in tool:
-            response = use_loop(user_input)
-            print(response)
-            res = voice.text_to_speech.convert_as_stream(
-                voice_id="pMsXgVXv3BLzUgSXRplE",
-                optimize_streaming_latency="0",
-                output_format="mp3_22050_32",
-                text=response,
-                voice_settings=VoiceSettings(
-                    stability=0.1,
-                    similarity_boost=0.3,
-                    style=0.2,
-                ),
-            )
-            stream(res)
-        elif "recall_previous_image" in tool:
-            response = use_recall(user_input)
+        use_user_input(user_input)
+
+
+def use_user_input(user_input):
+    tracing.start_request()
+    utterance = get_speaker().utterance()
+    try:
+        response = run_tool(user_input, utterance)
+        if response is not None:
             print(response)
-            res = voice.text_to_speech.convert_as_stream(
-                voice_id="pMsXgVXv3BLzUgSXRplE",
-                optimize_streaming_latency="0",
-                output_format="mp3_22050_32",
-                text=response,
-                voice_settings=VoiceSettings(
-                    stability=0.1,
-                    similarity_boost=0.3,
-                    style=0.2,
-                ),
+            # replies that were not streamed (cache hits, use_loop) are
+            # spoken in one piece
+            if not utterance.spoken:
+                utterance.say(response)
+    except BaseException:
+        utterance.cancel()
+        raise
+    finally:
+        utterance.finish()
+    utterance.wait()
+
+
+async def _in_executor(fn, *args):
+    # run_in_executor does not carry contextvars over, so the trace request id
+    # is propagated explicitly.
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, ctx.run, fn, *args
+    )
+
+
+async def _acreate(name, request):
+    priority = PRIORITIES.get(name, governor.INTERACTIVE)
+    with tracing.span("llm." + name, priority=governor.NAMES[priority]) as span:
+        response = await governor.default.acall(
+            lambda: get_aclient().messages.create(**request),
+            priority,
+            governor.estimate_tokens(request),
+            session().id,
+            key=governor.request_key(request),
+            retries=RETRIES[priority],
+        )
+        span.usage(response)
+    return response
+
+
+async def _acomplete(name, request, utterance=None):
+    if utterance is None:
+        return (await _acreate(name, request)).content[0].text
+    with _Stream(name, request, utterance) as stream:
+        for attempt in stream.attempts():
+            with attempt:
+                async with governor.default.aslot(
+                    stream.priority, stream.tokens, session().id
+                ) as grant:
+                    async with get_aclient().messages.stream(**request) as response:
+                        async for delta in response.text_stream:
+                            stream.push(delta)
+                        stream.finish(await response.get_final_message(), grant)
+    return stream.text
+
+
+async def aselect_tool(user_query: str):
+    response = await _acreate("tool", _tool_request(user_query))
+    return response.content[0].text
+
+
+async def aget_tool(user_query: str, select=aselect_tool):
+    with tracing.span("get_tool") as span:
+        tool = await tool_router.aroute(user_query, select)
+        span.update(tool=tool)
+    return tool
+
+
+async def ause_current_image(user_query: str, utterance=None):
+    with tracing.span("frame"):
+        frame = await _in_executor(session().current_frame)
+    cached = await _in_executor(session().answers.get, frame, user_query)
+    if cached is not None:
+        return cached
+    image = await _in_executor(
+        imageprep.prepare, frame, "use_current_image", user_query
+    )
+
+    answer = await _acomplete(
+        "current_image", _current_image_request(user_query, image), utterance
+    )
+
+    session().answers.put(frame, user_query, answer)
+    return answer
+
+
+async def aevaluate_conditions(conditions, frame):
+    # One VLM call for every pending watch. Conditions are renumbered 1..n
+    # in the prompt and mapped back to watch ids.
+    ids = list(conditions)
+    image = await _in_executor(
+        imageprep.prepare, frame, "use_loop", " ".join(conditions.values())
+    )
+    numbered = [(i + 1, conditions[watch_id]) for i, watch_id in enumerate(ids)]
+    response = await _acreate("watch", _watch_request(numbered, image))
+    print(response.content[0].text)
+    met = _parse_watch_response(response.content[0].text)
+    return {ids[n - 1]: text for n, text in met.items() if 0 < n <= len(ids)}
+
+
+# Used when no session is active: the CLI, bench.py and single-user runs
+# read the process-wide frame buffer (or latest.jpeg).
+default_session = sessions.Session(
+    aevaluate_conditions,
+    session_id="default",
+    buffer=frames.buffer,
+    frame_source=frames.current,
+)
+
+
+def session():
+    return sessions.current.get() or default_session
+
+
+async def ause_loop(user_query: str, timeout=WATCH_TIMEOUT):
+    response = await _acreate("stop_condition", _stop_condition_request(user_query))
+    return _start_watch(response.content[0].text, timeout)
+
+
+def _start_watch(stop_condition, timeout=WATCH_TIMEOUT):
+    # The watch belongs to the session, not to the request that asked for
+    # it: a later utterance cancels the request but the watch keeps running
+    # until its condition is met, it times out, or the user says to stop.
+    print("INFO: stop condition: " + stop_condition)
+    speaker = session_speaker()
+
+    async def announce(watch, description):
+        print("INFO: condition met: " + description)
+        await asay(description, speaker)
+
+    async def expire(watch):
+        print("INFO: watch expired: " + stop_condition)
+        await asay(WATCH_EXPIRED, speaker)
+
+    session().watches.add(stop_condition, announce, timeout=timeout, on_timeout=expire)
+    return WATCH_STARTED
+
+
+def stop_watching():
+    cancelled = session().watches.clear()
+    print(f"INFO: cancelled {cancelled} watches")
+    return WATCH_STOPPED
+
+
+async def ause_recall(query_string, utterance=None):
+    response = await _acreate("keywords", _keywords_request(query_string))
+    return await _arecall_with_keywords(
+        query_string, response.content[0].text, utterance
+    )
+
+
+async def _arecall_with_keywords(query_string, keywords, utterance=None):
+    print("INFO: keywords: " + keywords)
+
+    if RECALL_FRAMES > 1:
+        recalled = await _in_executor(recall_frames, keywords)
+        if len(recalled) > 1:
+            image = await _in_executor(recall_grid, recalled, query_string)
+            answer = await _acomplete(
+                "recall_grid",
+                _recall_grid_request(query_string, image),
+                utterance and _Uncited(utterance),
             )
-            stream(res)
+            print("INFO: recall answer: " + answer)
+            return answer
+        if recalled:
+            # a lone match is sent on its own, not as a small grid tile
+            return await _arecall_loaded(recalled[0], query_string, utterance)
 
+    key = await _in_executor(find_memory, keywords)
+    if key is None:
+        return NOT_REMEMBERED
+    print("INFO: image path: " + key)
 
-def use_user_input(user_input):
-    tool = get_tool(user_input)
+    return await arecall_frame(key, query_string, utterance)
+
+
+async def arecall_frame(key, query_string, utterance=None):
+    frame = await _in_executor(_load_remembered, key)
+    if frame is None:
+        return NOT_REMEMBERED
+    return await _arecall_loaded(frame, query_string, utterance)
+
+
+async def _arecall_loaded(frame, query_string, utterance=None):
+    image = await _in_executor(imageprep.prepare, frame, "use_recall")
+
+    return await _acomplete(
+        "recall", _recall_request(query_string, image), utterance
+    )
+
+
+async def arun_tool(user_input, utterance=None):
+    tool = await aget_tool(user_input)
+    print("INFO: using tool " + tool)
+    if "use_current_image" in tool:
+        with tracing.span("tool.use_current_image"):
+            return await ause_current_image(user_input, utterance)
+    elif "use_loop" in tool:
+        with tracing.span("tool.use_loop"):
+            return await ause_loop(user_input)
+    elif "recall_previous_image" in tool:
+        with tracing.span("tool.recall_previous_image"):
+            return await ause_recall(user_input, utterance)
+    return None
+
+
+async def arun_tool_speculative(user_input, utterance=None):
+    # While the tool selector is in flight, snapshot the frame and start both
+    # the current-image answer and the recall keyword extraction. The branch
+    # matching the selected tool is kept and the others are discarded.
+    if tool_router.lookup(user_input) is not None or not speculation_limiter.allowed():
+        return await arun_tool(user_input, utterance)
+
+    selection = asyncio.create_task(aget_tool(user_input))
+    frame = cached = image = branches = None
+    try:
+        try:
+            with tracing.span("frame"):
+                frame = await _in_executor(session().current_frame)
+        except RuntimeError as e:
+            # no video yet: only the current-image branch needs a frame
+            print("INFO: not speculating on the current image: " + repr(e))
+        if frame is not None:
+            cached = await _in_executor(session().answers.get, frame, user_input)
+            if cached is None:
+                image = await _in_executor(
+                    imageprep.prepare, frame, "use_current_image", user_input
+                )
+        # the coroutines become tasks right away, so none is left unawaited
+        coros = {
+            "recall_previous_image": _acreate("keywords", _keywords_request(user_input)),
+        }
+        estimates = {"recall_previous_image": len(KEYWORD_PROMPT) // 4}
+        if image is not None:
+            coros["use_current_image"] = _acreate(
+                "current_image", _current_image_request(user_input, image)
+            )
+            estimates["use_current_image"] = image.tokens + len(CURRENT_IMAGE_PROMPT) // 4
+        branches = speculate.Speculation(speculation_limiter, coros, estimates)
+        tool = await selection
+    except BaseException:
+        selection.cancel()
+        if branches is not None:
+            branches.discard()
+        raise
     print("INFO: using tool " + tool)
+    return await _take_branch(tool, branches, user_input, utterance, frame, cached)
+
+
+async def _take_branch(tool, branches, user_input, utterance, frame=None, cached=None):
+    # Finishes the request along tool's path from its speculative branch,
+    # or from scratch when none was started; the other branches are
+    # discarded. cached is an answer-cache hit for frame.
     if "use_current_image" in tool:
-        response = use_current_image(user_input)
-        print(response)
-        res = voice.text_to_speech.convert_as_stream(
-            voice_id="pMsXgVXv3BLzUgSXRplE",
-            optimize_streaming_latency="0",
-            output_format="mp3_22050_32",
-            text=response,
-            voice_settings=VoiceSettings(
-                stability=0.1,
-                similarity_boost=0.3,
-                style=0.2,
-            ),
+        if cached is not None:
+            branches.discard()
+            return cached
+        if "use_current_image" not in branches:
+            branches.discard()
+            return await ause_current_image(user_input, utterance)
+        response = await branches.take("use_current_image")
+        session().answers.put(frame, user_input, response.content[0].text)
+        return response.content[0].text
+    elif "recall_previous_image" in tool:
+        if "recall_previous_image" not in branches:
+            branches.discard()
+            return await ause_recall(user_input, utterance)
+        response = await branches.take("recall_previous_image")
+        return await _arecall_with_keywords(
+            user_input, response.content[0].text, utterance
         )
-        stream(res)
-        # play(res)
     elif "use_loop" in tool:
-        response = use_loop(user_input)
-        print(response)
-        res = voice.text_to_speech.convert_as_stream(
-            voice_id="pMsXgVXv3BLzUgSXRplE",
-            optimize_streaming_latency="0",
-            output_format="mp3_22050_32",
-            text=response,
-            voice_settings=VoiceSettings(
-                stability=0.1,
-                similarity_boost=0.3,
-                style=0.2,
-            ),
+        if "use_loop" not in branches:
+            branches.discard()
+            return await ause_loop(user_input)
+        response = await branches.take("use_loop")
+        return _start_watch(response.content[0].text)
+    branches.discard()
+    return None
+
+
+class Prestart:
+    # Work started from a stable interim transcript, before the endpointer
+    # finalizes it: the tool choice, a frame snapshot and the first request
+    # of that tool's path, all without speaking. The final transcript
+    # confirms it when the text is close enough, otherwise it is discarded
+    # and its spend, the LLM tool selection included, charged to the
+    # speculation limiter.
+    SIMILARITY = 0.85
+
+    def __init__(self, text, session=None):
+        self.text = text
+        self.session = session
+        self.tool = None
+        self.frame = None
+        self.cached = None
+        self.branches = None
+        self.selector_tokens = 0
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        if self.session is not None:
+            self.session.activate()
+        with tracing.span("prestart", text=self.text) as span:
+            self.tool = await aget_tool(self.text, self._select)
+            span.update(tool=self.tool)
+            coros, estimates = {}, {}
+            if "use_current_image" in self.tool:
+                self.frame = await _in_executor(session().current_frame)
+                self.cached = await _in_executor(
+                    session().answers.get, self.frame, self.text
+                )
+                if self.cached is None:
+                    image = await _in_executor(
+                        imageprep.prepare, self.frame, "use_current_image", self.text
+                    )
+                    coros["use_current_image"] = _acreate(
+                        "current_image", _current_image_request(self.text, image)
+                    )
+                    estimates["use_current_image"] = (
+                        image.tokens + len(CURRENT_IMAGE_PROMPT) // 4
+                    )
+            elif "recall_previous_image" in self.tool:
+                coros["recall_previous_image"] = _acreate(
+                    "keywords", _keywords_request(self.text)
+                )
+                estimates["recall_previous_image"] = len(KEYWORD_PROMPT) // 4
+            elif "use_loop" in self.tool:
+                coros["use_loop"] = _acreate(
+                    "stop_condition", _stop_condition_request(self.text)
+                )
+                estimates["use_loop"] = len(STOP_CONDITION_PROMPT) // 4
+            self.branches = speculate.Speculation(speculation_limiter, coros, estimates)
+
+    async def _select(self, text):
+        # Only reached when the router is unsure of the interim text.
+        speculation_limiter.started("tool")
+        self.selector_tokens = len(TOOL_SELECTOR_PROMPT) // 4
+        response = await _acreate("tool", _tool_request(text))
+        self.selector_tokens = speculate.response_tokens(response)
+        return response.content[0].text
+
+    def matches(self, text):
+        if router.similarity(text, self.text) < self.SIMILARITY:
+            return False
+        # a final transcript that clearly routes elsewhere is a different request
+        tool = tool_router.lookup(text)
+        return tool is None or self.tool is None or tool == self.tool
+
+    def discard(self):
+        self.task.cancel()
+        if self.branches is not None:
+            self.branches.discard()
+        if self.selector_tokens:
+            speculation_limiter.wasted("tool", self.selector_tokens)
+            self.selector_tokens = 0
+
+    async def run(self, user_input, utterance=None):
+        # Finishes the request for the confirmed final transcript.
+        try:
+            await self.task
+        except Exception as e:
+            self.selector_tokens = 0
+            print("ERROR: prestart failed: " + repr(e))
+            return await arun_tool(user_input, utterance)
+        if self.selector_tokens:
+            speculation_limiter.won("tool")
+            self.selector_tokens = 0
+        print("INFO: using prestarted tool " + self.tool)
+        return await _take_branch(
+            self.tool, self.branches, user_input, utterance, self.frame, self.cached
         )
-        stream(res)
-    elif "recall_previous_image" in tool:
-        response = use_recall(user_input)
-        print(response)
-        res = voice.text_to_speech.convert_as_stream(
-            voice_id="pMsXgVXv3BLzUgSXRplE",
-            optimize_streaming_latency="0",
-            output_format="mp3_22050_32",
-            text=response,
-            voice_settings=VoiceSettings(
-                stability=0.1,
-                similarity_boost=0.3,
-                style=0.2,
-            ),
+
+
+async def ause_user_input(user_input, speculative=False, prestart=None):
+    # Cancelling this task (barge-in) stops the LLM stream and the audio.
+    if tracing.request_id.get() is None:
+        tracing.start_request()
+    utterance = session_speaker().utterance()
+    try:
+        if STOP_WATCHING.search(router.normalize(user_input)):
+            if prestart is not None:
+                prestart.discard()
+            response = stop_watching()
+        elif prestart is not None:
+            response = await prestart.run(user_input, utterance)
+        elif speculative:
+            response = await arun_tool_speculative(user_input, utterance)
+        else:
+            response = await arun_tool(user_input, utterance)
+        if response is not None:
+            print(response)
+            if not utterance.spoken:
+                utterance.say(response)
+        utterance.finish()
+        # playback waits on the utterance's own threads, not the pool
+        await utterance.finished()
+    except BaseException:
+        utterance.cancel()
+        raise
+
+
+class ToolDispatcher:
+    # Runs each utterance as its own task on the event loop. A new utterance
+    # cancels whatever is still running, so one slow query never holds up
+    # the session; watches live in the session's scheduler and are not
+    # affected (see stop_watching). With a session, its tasks run with
+    # that session active. With early_start, an interim transcript that has
+    # not changed for stable_for seconds starts a Prestart.
+    def __init__(
+        self, speculative=False, session=None, early_start=False, stable_for=0.3
+    ):
+        self.speculative = speculative
+        self.session = session
+        self.early_start = early_start
+        self.stable_for = stable_for
+        self._task = None
+        self._timer = None
+        self._prestart = None
+
+    def interim(self, text):
+        if not self.early_start or not router.normalize(text):
+            return
+        started = self._prestart
+        if started is not None and router.normalize(started.text) == router.normalize(text):
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(
+            self.stable_for, self._start_early, text
         )
-        stream(res)
+
+    def _start_early(self, text):
+        self._timer = None
+        if not speculation_limiter.allowed():
+            return
+        if self._prestart is not None:
+            self._prestart.discard()
+        self._prestart = Prestart(text, self.session)
+
+    def submit(self, user_input):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        prestart, self._prestart = self._prestart, None
+        if prestart is not None and not prestart.matches(user_input):
+            print("INFO: discarding prestart for " + repr(prestart.text))
+            prestart.discard()
+            prestart = None
+        self.cancel()
+        self._task = asyncio.create_task(self._run(user_input, prestart))
+        self._task.add_done_callback(self._done)
+        return self._task
+
+    async def _run(self, user_input, prestart=None):
+        # a task runs in a copy of the context, so this does not leak out
+        if self.session is not None:
+            self.session.activate()
+        try:
+            await ause_user_input(
+                user_input, speculative=self.speculative, prestart=prestart
+            )
+        except BaseException:
+            if prestart is not None:
+                prestart.discard()
+            raise
+
+    def cancel(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def _done(self, task):
+        if task.cancelled():
+            print("INFO: tool task cancelled")
+        elif task.exception() is not None:
+            print("ERROR: tool task failed: " + repr(task.exception()))
+
+    async def aclose(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._prestart is not None:
+            self._prestart.discard()
+        self.cancel()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def _warm_anthropic():
+    client = get_client()
+    get_aclient()
+    try:
+        client.models.list(limit=1)
+    except Exception as e:
+        # any HTTP answer means the connection is open
+        if getattr(e, "status_code", None) is None:
+            raise
+
+
+def _warm_vision():
+    # the first JPEG encode, and the detectors the prefilter builds lazily
+    imageprep.encode(np.zeros((432, 768, 3), np.uint8), imageprep.DEFAULT)
+    prefilter.screen_for("a person")
+
+
+def _warm_memory():
+    memory_store()
+    if memory_index() is not None:
+        embeddings.text("warm-up")
+
+
+def _warm_camera(timeout=5.0):
+    capture.camera.start()
+    if frames.buffer.wait_newer(0, timeout) is None:
+        print(f"WARNING: no camera frame within {timeout}s")
+
+
+def _warm_step(name, step):
+    try:
+        with tracing.span("startup.warm." + name):
+            step()
+    except Exception as e:
+        print(f"WARNING: warm-up of {name} failed: {e!r}")
+
+
+def warm_up(camera=False):
+    # Everything a first request would otherwise wait for, in parallel:
+    # the API clients and a connection, the speaker and canned phrases, the
+    # image encoder and detectors, the memory store and embedding model,
+    # and with camera the capture loop up to its first frame. Each step is
+    # a startup.* span; a failed step is only logged.
+    steps = {
+        "anthropic": _warm_anthropic,
+        "speech": lambda: get_speaker().warm(),
+        "vision": _warm_vision,
+        "memory": _warm_memory,
+    }
+    if camera:
+        steps["camera"] = _warm_camera
+    with ThreadPoolExecutor(len(steps), thread_name_prefix="warm") as pool:
+        for name, step in steps.items():
+            pool.submit(_warm_step, name, step)
+
+
+async def awarm_up():
+    # warm_up from the event loop, plus a connection for the async client,
+    # whose pool belongs to the loop it is used on.
+    async def connect():
+        client = await asyncio.to_thread(get_aclient)
+        try:
+            await client.models.list(limit=1)
+        except Exception as e:
+            if getattr(e, "status_code", None) is None:
+                raise
+
+    async def step():
+        try:
+            with tracing.span("startup.warm.anthropic_async"):
+                await connect()
+        except Exception as e:
+            print(f"WARNING: warm-up of anthropic_async failed: {e!r}")
+
+    await asyncio.gather(asyncio.to_thread(warm_up), step())
+
+
+def _ingest_keyframes(ingestor, keyframes):
+    def on_frame(frame):
+        if keyframes.should_store(frame):
+            ingestor.submit(frame, frame.seq)
+            if keyframes.selected % 50 == 0:
+                print("INFO: ingest " + str(ingestor.stats()))
+
+    return on_frame
 
 
 if __name__ == "__main__":
@@ -305,24 +1305,33 @@ if __name__ == "__main__":
     # input_thread.daemon = True
     # input_thread.start()
 
-    cam = cv2.VideoCapture(0)
-    frame_counter = 0
-    while cam.isOpened():
-        ret, frame = cam.read()
-        if not ret:
-            break
-        # turn frame into base64
-        cv2.resize(frame, (480, 270))
-        cv2.imshow("frame", frame)
-
-        if frame_counter % 30 == 0:
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            threading.Thread(
-                target=dbutils.store_frame, args=(img, frame_counter)
-            ).start()
-
-        frame_counter += 1
-        if cv2.waitKey(1) & 0xFF == ord("q"):
-            break
-    cam.release()
-    cv2.destroyAllWindows()
+    headless = "--headless" in sys.argv
+    tracing.record("startup.import", time.perf_counter() - tracing.STARTED)
+
+    ingestor = ingest.Ingestor(store_frame)
+    keyframes = scene.KeyframeSelector()
+    capture.camera.subscribe(
+        "ingest", _ingest_keyframes(ingestor, keyframes), fps=5
+    )
+    preview = None if headless else capture.camera.subscribe("preview", fps=30)
+    warm_up(camera=True)
+    print("INFO: " + tracing.startup.report())
+    try:
+        while capture.camera.running:
+            if preview is None:
+                time.sleep(0.5)
+                continue
+            frame = preview.get(timeout=1)
+            if frame is None:
+                continue
+            cv2.imshow("frame", frame.image)
+            if cv2.waitKey(1) & 0xFF == ord("q"):
+                break
+    except KeyboardInterrupt:
+        pass
+    capture.camera.stop()
+    if preview is not None:
+        cv2.destroyAllWindows()
+    ingestor.close(timeout=10)
+    print("INFO: capture " + str(capture.camera.stats()))
+    print("INFO: ingest " + str(ingestor.stats()))
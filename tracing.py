@@ -0,0 +1,197 @@
+import bisect
+import contextvars
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from loguru import logger
+
+
+request_id = contextvars.ContextVar("request_id", default=None)
+request_started = contextvars.ContextVar("request_started", default=None)
+
+# when tracing was first imported, as close to process start as it gets
+STARTED = time.perf_counter()
+
+_exporters = []
+
+
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.request_id = request_id.get()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attrs = attrs
+
+    def update(self, **attrs):
+        self.attrs.update(attrs)
+
+    def usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.attrs["input_tokens"] = usage.input_tokens
+            self.attrs["output_tokens"] = usage.output_tokens
+            # prompt cache hits and misses, 0 when nothing was cacheable
+            self.attrs["cache_read_tokens"] = getattr(usage, "cache_read_input_tokens", None) or 0
+            self.attrs["cache_write_tokens"] = getattr(usage, "cache_creation_input_tokens", None) or 0
+
+
+def add_exporter(exporter):
+    # An exporter is any callable taking a finished Span.
+    _exporters.append(exporter)
+    return exporter
+
+
+def remove_exporter(exporter):
+    _exporters.remove(exporter)
+
+
+def _export(span):
+    for exporter in list(_exporters):
+        try:
+            exporter(span)
+        except Exception as e:
+            logger.warning(f"trace exporter {exporter!r} failed: {e!r}")
+
+
+def start_request(rid=None):
+    # Begins a traced request in the current context. asyncio tasks created
+    # afterwards inherit it; threads need contextvars.copy_context().
+    rid = rid or uuid.uuid4().hex[:12]
+    request_id.set(rid)
+    request_started.set(time.perf_counter())
+    return rid
+
+
+@contextmanager
+def span(name, **attrs):
+    current = Span(name, attrs)
+    try:
+        yield current
+    except BaseException as e:
+        current.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _export(current)
+
+
+def record(name, duration, **attrs):
+    current = Span(name, attrs)
+    current.start -= duration
+    current.duration = duration
+    _export(current)
+
+
+def since_request_start():
+    started = request_started.get()
+    return None if started is None else time.perf_counter() - started
+
+
+class LogExporter:
+    def __init__(self, level="DEBUG"):
+        self.level = level
+
+    def __call__(self, span):
+        logger.bind(
+            span=span.name,
+            request_id=span.request_id,
+            duration_ms=round(span.duration * 1000, 1),
+            **span.attrs,
+        ).log(
+            self.level,
+            f"span {span.name} [{span.request_id}] {span.duration * 1000:.1f}ms {span.attrs}",
+        )
+
+
+class HistogramExporter:
+    # Latency histograms per span name, with optional SLOs in seconds; a span
+    # over its SLO is logged as a warning.
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, slos=None):
+        self.slos = dict(slos or {})
+        self._lock = threading.Lock()
+        self._counts = defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))
+        self._samples = defaultdict(list)
+
+    def __call__(self, span):
+        with self._lock:
+            self._counts[span.name][bisect.bisect_left(self.BUCKETS, span.duration)] += 1
+            samples = self._samples[span.name]
+            samples.append(span.duration)
+            if len(samples) > 1000:
+                del samples[:500]
+        slo = self.slos.get(span.name)
+        if slo is not None and span.duration > slo:
+            logger.warning(
+                f"span {span.name} [{span.request_id}] took {span.duration:.2f}s, SLO {slo:.2f}s"
+            )
+
+    def summary(self):
+        with self._lock:
+            result = {}
+            for name, samples in self._samples.items():
+                ordered = sorted(samples)
+                result[name] = {
+                    "count": sum(self._counts[name]),
+                    "p50": ordered[len(ordered) // 2],
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max": ordered[-1],
+                    "buckets": list(self._counts[name]),
+                }
+            return result
+
+
+class TokenExporter:
+    # Token totals per span name for spans that recorded usage, including
+    # how much input was read from or written to the prompt cache.
+    FIELDS = ("input_tokens", "output_tokens", "cache_read_tokens", "cache_write_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = defaultdict(lambda: dict.fromkeys(("calls",) + self.FIELDS, 0))
+
+    def __call__(self, span):
+        if "input_tokens" not in span.attrs:
+            return
+        with self._lock:
+            totals = self._totals[span.name]
+            totals["calls"] += 1
+            for field in self.FIELDS:
+                totals[field] += span.attrs.get(field, 0)
+
+    def summary(self):
+        with self._lock:
+            return {name: dict(totals) for name, totals in self._totals.items()}
+
+
+class StartupExporter:
+    # Durations of the startup.* spans (imports, warm-up steps), in the
+    # order they finished, for one breakdown line once the process is ready.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+
+    def __call__(self, span):
+        if span.name.startswith("startup."):
+            with self._lock:
+                self._phases[span.name[len("startup.") :]] = span.duration
+
+    def summary(self):
+        with self._lock:
+            return dict(self._phases)
+
+    def report(self):
+        total = time.perf_counter() - STARTED
+        phases = ", ".join(f"{name} {duration * 1000:.0f}ms" for name, duration in self.summary().items())
+        return f"startup {total * 1000:.0f}ms: {phases}"
+
+
+histograms = add_exporter(HistogramExporter())
+tokens = add_exporter(TokenExporter())
+startup = add_exporter(StartupExporter())
+add_exporter(LogExporter())
@@ -0,0 +1,226 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class Hit:
+    def __init__(self, key, score, timestamp):
+        self.key = key
+        self.score = score
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return f"Hit({self.key!r}, {self.score:.3f}, {self.timestamp})"
+
+
+class _Column:
+    # An append-only memory-mapped array that doubles its file when full.
+    def __init__(self, path, dtype, width=None):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.width = width
+        self.array = None
+        self.capacity = 0
+        if not os.path.exists(path):
+            open(path, "wb").close()
+
+    def _row_bytes(self):
+        return self.dtype.itemsize * (self.width or 1)
+
+    def open(self, count):
+        size = os.path.getsize(self.path)
+        capacity = size // self._row_bytes()
+        if capacity < max(count, 1):
+            capacity = max(count, 1024)
+            with open(self.path, "r+b") as f:
+                f.truncate(capacity * self._row_bytes())
+        shape = (capacity, self.width) if self.width else (capacity,)
+        self.array = np.memmap(self.path, dtype=self.dtype, mode="r+", shape=shape)
+        self.capacity = capacity
+
+    def ensure(self, count):
+        if count <= self.capacity:
+            return
+        self.array.flush()
+        self.array = None
+        capacity = self.capacity
+        while capacity < count:
+            capacity *= 2
+        with open(self.path, "r+b") as f:
+            f.truncate(capacity * self._row_bytes())
+        shape = (capacity, self.width) if self.width else (capacity,)
+        self.array = np.memmap(self.path, dtype=self.dtype, mode="r+", shape=shape)
+        self.capacity = capacity
+
+    def flush(self):
+        if self.array is not None:
+            self.array.flush()
+
+
+class VectorIndex:
+    # On-disk IVF index over normalized float16 vectors. Vectors, timestamps
+    # and list assignments are memory-mapped columns, so opening an existing
+    # index does not rebuild anything. Until train_size vectors exist every
+    # query is an exact scan; after that the index trains nlist k-means
+    # centroids once and each query only scans the nprobe nearest lists.
+    # remove() tombstones entries in a dead column that searches skip.
+    def __init__(self, path, dim, nlist=256, nprobe=8, train_size=4096):
+        self.path = path
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._vectors = _Column(os.path.join(path, "vectors.f16"), np.float16, dim)
+        self._times = _Column(os.path.join(path, "times.f64"), np.float64)
+        self._lists = _Column(os.path.join(path, "lists.i32"), np.int32)
+        # an index written before tombstones gets an all-zero column
+        self._dead = _Column(os.path.join(path, "dead.u8"), np.uint8)
+        self._columns = (self._vectors, self._times, self._lists, self._dead)
+        self._keys_path = os.path.join(path, "keys.txt")
+        self._meta_path = os.path.join(path, "index.json")
+        self._centroids_path = os.path.join(path, "centroids.npy")
+        self._meta_mtime = None
+        self._load()
+
+    def _load(self):
+        with self._lock:
+            meta = {"dim": self.dim, "count": 0}
+            if os.path.exists(self._meta_path):
+                with open(self._meta_path) as f:
+                    meta = json.load(f)
+                self._meta_mtime = os.stat(self._meta_path).st_mtime_ns
+            if meta["dim"] != self.dim:
+                raise ValueError(
+                    f"index at {self.path} has dim {meta['dim']}, expected {self.dim}"
+                )
+            self.count = meta["count"]
+            for column in self._columns:
+                column.open(self.count)
+            self._keys = []
+            if os.path.exists(self._keys_path):
+                with open(self._keys_path) as f:
+                    self._keys = [line.rstrip("\n") for line in f]
+            # more keys than count means an insert was interrupted before its
+            # metadata was written (or is in progress in another process)
+            self._stale_keys = len(self._keys) > self.count
+            self._keys = self._keys[: self.count]
+            self._centroids = None
+            if os.path.exists(self._centroids_path):
+                self._centroids = np.load(self._centroids_path)
+
+    def refresh(self):
+        # Pick up inserts made by another process writing the same index.
+        try:
+            mtime = os.stat(self._meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._meta_mtime:
+            self._load()
+
+    def __len__(self):
+        return self.count
+
+    def _write_meta(self):
+        tmp = self._meta_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"dim": self.dim, "count": self.count}, f)
+        os.replace(tmp, self._meta_path)
+        self._meta_mtime = os.stat(self._meta_path).st_mtime_ns
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _train(self):
+        data = self._vectors.array[: self.count].astype(np.float32)
+        rng = np.random.default_rng(0)
+        centroids = data[rng.choice(len(data), self.nlist, replace=False)]
+        for _ in range(10):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            for i in range(self.nlist):
+                members = data[labels == i]
+                if len(members):
+                    centroids[i] = members.mean(axis=0)
+            centroids = self._normalize(centroids)
+        self._centroids = centroids
+        np.save(self._centroids_path, centroids)
+        self._lists.array[: self.count] = self._assign(data)
+
+    def add(self, vector, key, timestamp):
+        if "\n" in key:
+            raise ValueError("keys must not contain newlines")
+        vector = self._normalize(vector).reshape(1, self.dim)
+        with self._lock:
+            n = self.count
+            for column in self._columns:
+                column.ensure(n + 1)
+            self._vectors.array[n] = vector[0]
+            self._dead.array[n] = 0
+            self._times.array[n] = timestamp
+            self._lists.array[n] = -1 if self._centroids is None else self._assign(vector)[0]
+            if self._stale_keys:
+                with open(self._keys_path, "w") as f:
+                    f.writelines(k + "\n" for k in self._keys)
+                self._stale_keys = False
+            with open(self._keys_path, "a") as f:
+                f.write(key + "\n")
+            self._keys.append(key)
+            self.count = n + 1
+            if self._centroids is None and self.count >= max(self.train_size, self.nlist):
+                self._train()
+            for column in self._columns:
+                column.flush()
+            self._write_meta()
+
+    def remove(self, keys):
+        # Tombstones every entry with one of keys; returns how many.
+        keys = set(keys)
+        with self._lock:
+            ids = [i for i, key in enumerate(self._keys) if key in keys]
+            if not ids:
+                return 0
+            self._dead.array[ids] = 1
+            self._dead.flush()
+            # other processes reload on the metadata changing
+            self._write_meta()
+            return len(ids)
+
+    def search(self, vector, k=1, since=None, until=None):
+        query = self._normalize(vector).reshape(self.dim)
+        with self._lock:
+            n = self.count
+            if n == 0:
+                return []
+            times = self._times.array[:n]
+            mask = self._dead.array[:n] == 0
+            if since is not None:
+                mask &= times >= since
+            if until is not None:
+                mask &= times <= until
+            ids = np.flatnonzero(mask)
+            if self._centroids is not None:
+                probes = np.argsort(self._centroids @ query)[-self.nprobe :]
+                probed = ids[np.isin(self._lists.array[ids], probes)]
+                # a narrow time range may have too few candidates in the
+                # probed lists; scan the whole range exactly instead
+                if len(probed) >= k:
+                    ids = probed
+            if len(ids) == 0:
+                return []
+            scores = self._vectors.array[ids].astype(np.float32) @ query
+            top = min(k, len(ids))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            return [
+                Hit(self._keys[ids[i]], float(scores[i]), float(times[ids[i]]))
+                for i in best
+            ]
@@ -5,272 +5,374 @@
 #
 
 import asyncio
+import functools
+import json
 from typing import Any, Dict
 import aiohttp
 import os
 import sys
+import threading
+import time
+
+import tracing
 
-from pipecat.audio.vad.silero import SileroVADAnalyzer
-from pipecat.pipeline.pipeline import Pipeline
-from pipecat.pipeline.runner import PipelineRunner
-from pipecat.pipeline.task import PipelineTask
-from pipecat.services.cartesia import CartesiaTTSService
-from pipecat.services.anthropic import AnthropicLLMContext, AnthropicLLMService
-from pipecat.transports.services.daily import DailyParams, DailyTransport
+with tracing.span("startup.import.pipecat"):
+    from pipecat.frames.frames import EndFrame, OutputAudioRawFrame, UserImageRawFrame
+    from pipecat.pipeline.pipeline import Pipeline
+    from pipecat.pipeline.runner import PipelineRunner
+    from pipecat.pipeline.task import PipelineTask
+    from pipecat.processors.frame_processor import FrameProcessor
+    from pipecat.services.anthropic import AnthropicLLMContext, AnthropicLLMService
+    from pipecat.transports.services.daily import DailyParams, DailyTransport
 
 from runner import configure
 from loguru import logger
 from dotenv import load_dotenv
 
-import dbutils
-import anthropic
-import base64
-
-import tools
-
-import asyncio
-import cv2
-from PIL import Image
-import threading
+with tracing.span("startup.import.tools"):
+    import dbutils
+    import sessions
+    import tools
 
 load_dotenv(override=True)
 
 logger.remove(0)
 logger.add(sys.stderr, level="DEBUG")
 
-video_participant_id = None
-
-client = anthropic.Anthropic()
-
-
-def wait_for(condition, img):
-    system_prompt = f"""You are analyzing an image. You must answer if a condition has been met or not within the supplied image.
-    Based on the objects or characteristics in the image, respond with "Yes" or "No". If you respond with "Yes", you must
-    also describe what the condition is that has been met and where it is in the image. Otherwise, only respond with "No" and
-    nothing else.
-
-    EXAMPLE USER INPUT: "there is a blue object in the image"
-    If you see a blue object in the image, you should respond with something like "Yes, there is a blue object in the image. It appears to be a blue water bottle on a desk and appears next to a notebook."
-    If you do not see a blue object in the image, you should respond with "No".
-
-    EXAMPLE USER INPUT: "there is a cat in the image"
-    If you see a cat in the image, you should respond with something like "Yes, there is a cat in the image. It is sitting on a chair."
-    If you do not see a cat in the image, you should respond with "No".
-
-    REMEMBER, if the condition is not met only respond with "No." If the condition is met, respond with "Yes" and briefly describe the condition in two sentences.
-    """
-
-    with open("latest.jpeg", "rb") as image_file:
-        image_data = image_file.read()
-
-    base64_image = base64.b64encode(image_data).decode("utf-8")
-
-    message = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=4096,
-        system=system_prompt,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "source": {
-                            "type": "base64",
-                            "media_type": "image/jpeg",
-                            "data": base64_image,
-                        },
-                    },
-                    {"type": "text", "text": f"Condition: {condition}"},
-                ],
-            }
-        ],
-    )
+# frames per second of each participant's video fed to their session
+VIDEO_FPS = float(os.getenv("VIDEO_FPS", "1"))
+
+SYSTEM_PROMPT = """\
+You are a helpful assistant who converses with a user and answers questions. Respond concisely to general questions.
 
-    print(message.content[0].text)
-    return message.content[0].text
+Your response will be turned into speech so use only simple words and punctuation.
+
+You have access to these tools:
+- get_current_image: You can use this tool to get the current user's image from the video stream. This tool should be used any time the user asks a question that may need a visual response. This should be the basic tool you use whenever a visual task is needed.
+- recall_item: This is used whenever the user asks you to recall an item. This tool is used for recalling items that the user is looking for from the past.
+- wait_for_condition: This tool is used to wait for a condition to be met in an image. The tool will keep asking the AI to analyze the image until the condition is met. This tool should be used if the user says something like 'Tell me when you see something blue'. When you use this tool, do not say anything to the user. Just wait for the condition to be met and then respond to the user.
+
+- Your output is directly streamed to the user.
+- Do not mention any tools you are using
+- Only use the tool, and do not say anything before using the tool.
+- Remember to be brief in your messages. Only say two sentences maximum.
+"""
+
+LLM_TOOLS = [
+    {
+        "name": "get_current_image",
+        "description": "This will get the current user's image from the video stream. This tool should be used any time the user asks a question that may need a visual response.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "user_request": {
+                    "type": "string",
+                    "description": "The user's request that requires a visual response. For example, 'What do you see in front of you?'",
+                },
+            },
+            "required": ["user_request"],
+        },
+    },
+    {
+        "name": "recall_item",
+        "description": "Recall an item that the user is looking for",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "item": {
+                    "type": "string",
+                    "description": "The item that the user is looking for",
+                },
+                "user_query": {
+                    "type": "string",
+                    "description": "The user's full query for what they are looking for. For example, 'where did I leave my glasses?'",
+                },
+            },
+            "required": ["item"],
+        },
+    },
+    {
+        "name": "wait_for_condition",
+        "description": "This tool is used to wait for a condition to be met in an image. The tool will keep asking the AI to analyze the image until the condition is met. This tool should be used if the user says something like 'Tell me when you see something blue'.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "condition": {
+                    "type": "string",
+                    "description": "The condition to wait for in the image. For example, if the user says 'Tell me when you see a cat', the condition will be 'a cat appears in the image'.",
+                }
+            },
+            "required": ["item"],
+        },
+    },
+]
 
 
 async def wait_for_condition(
-    function_name, tool_call_id, arguments, llm, context, result_callback
+    session, function_name, tool_call_id, arguments, llm, context, result_callback
 ):
     condition = arguments["condition"]
-    cam = cv2.VideoCapture(0)
-    frame_counter = 0
-    while cam.isOpened():
-        ret, frame = cam.read()
-        if not ret:
-            break
-        # turn frame into base64
-        cv2.resize(frame, (480, 270))
-
-        if frame_counter % 30 == 0:
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            result = wait_for(condition, img)
-            if "Yes" in result:
-                await result_callback("Yes, the condition has been met.")
-                break
-
-        frame_counter += 1
-        if cv2.waitKey(1) & 0xFF == ord("q"):
-            break
-    cam.release()
+
+    async def on_met(watch, description):
+        await result_callback("Yes, the condition has been met.")
+
+    async def on_timeout(watch):
+        await result_callback("No, the condition was not met before the watch timed out.")
+
+    session.watches.add(
+        condition, on_met, timeout=tools.WATCH_TIMEOUT, on_timeout=on_timeout
+    )
 
 
 async def get_current_image(
-    function_name, tool_call_id, arguments, llm, context, result_callback
+    session, function_name, tool_call_id, arguments, llm, context, result_callback
 ):
-    logger.debug(f"!!! IN get_current_image {video_participant_id}, {arguments}")
+    logger.debug(f"!!! IN get_current_image {session.participant_id}, {arguments}")
     question = arguments["user_request"]
-    await llm.request_image_frame(user_id=video_participant_id, text_content=question)
+    try:
+        frame = await asyncio.to_thread(session.current_frame)
+        cached = await asyncio.to_thread(session.answers.get, frame, question)
+    except RuntimeError:
+        cached = None
+    if cached is not None:
+        logger.debug(f"answer cache hit for {question!r}")
+        await result_callback(cached)
+        return
+    await llm.request_image_frame(user_id=session.participant_id, text_content=question)
 
 
 async def recall_item(
-    function_name, tool_call_id, arguments, llm, context, result_callback
+    session, function_name, tool_call_id, arguments, llm, context, result_callback
 ):
     item = arguments["item"]
     user_query = arguments["user_query"]
 
-    filename = dbutils.search(item)
-    response = dbutils.getResponse(filename, user_query)
+    tracing.start_request()
+    key = await asyncio.to_thread(tools.find_memory, item)
+    with tracing.span("llm.recall_item", session=session.id):
+        if key is None:
+            response = tools.NOT_REMEMBERED
+        elif tools.memory_store().owns(key):
+            # frames in the segment store have no file for dbutils to read
+            response = await tools.arecall_frame(key, user_query)
+        else:
+            response = await asyncio.to_thread(dbutils.getResponse, key, user_query)
 
     await result_callback(response)
 
 
-async def main():
-    async with aiohttp.ClientSession() as session:
-        (room_url, token) = await configure(session)
-
-        transport = DailyTransport(
-            room_url,
-            token,
-            "Respond bot",
-            DailyParams(
-                audio_out_enabled=True,
-                transcription_enabled=True,
-                vad_enabled=True,
-                vad_analyzer=SileroVADAnalyzer(),
-            ),
+class SessionFrames(FrameProcessor):
+    # Copies the followed participant's video into the session's frame
+    # buffer, where watches and the answer cache read it. Conversion runs on
+    # the shared tool pool.
+    def __init__(self, session):
+        super().__init__()
+        self.session = session
+
+    async def process_frame(self, frame, direction):
+        await super().process_frame(frame, direction)
+        if (
+            isinstance(frame, UserImageRawFrame)
+            and frame.user_id == self.session.participant_id
+        ):
+            await asyncio.get_running_loop().run_in_executor(
+                tools.executor,
+                self.session.push_image,
+                frame.image,
+                frame.size,
+                frame.format,
+            )
+        await self.push_frame(frame, direction)
+
+
+class TransportPlayer:
+    # Plays one reply in the session's room: the 16-bit mono PCM of a routed
+    # SpeechSink is queued into the pipeline as audio frames for
+    # transport.output(). close() returns once the audio has had time to
+    # play, as a local player process would.
+    SAMPLE_RATE = 16000
+    OUTPUT_FORMAT = f"pcm_{SAMPLE_RATE}"
+
+    def __init__(self, task, loop):
+        self._task = task
+        self._loop = loop
+        self._killed = threading.Event()
+        self._partial = b""
+        self._queued = 0
+        self._started = None
+
+    def write(self, audio):
+        if self._killed.is_set():
+            return
+        # a streamed chunk can end mid-sample
+        audio = self._partial + audio
+        whole = len(audio) - len(audio) % 2
+        self._partial = audio[whole:]
+        if not whole:
+            return
+        if self._started is None:
+            self._started = time.monotonic()
+        self._queued += whole
+        frame = OutputAudioRawFrame(
+            audio=audio[:whole], sample_rate=self.SAMPLE_RATE, num_channels=1
         )
+        asyncio.run_coroutine_threadsafe(self._task.queue_frame(frame), self._loop).result()
+
+    def close(self):
+        if self._started is None:
+            return
+        duration = self._queued / (2 * self.SAMPLE_RATE)
+        self._killed.wait(max(0.0, self._started + duration - time.monotonic()))
+
+    def kill(self):
+        self._killed.set()
+
+
+def load_vad():
+    # Loads the Silero model; one per session, as the analyzer keeps the
+    # stream's state. Done during warm-up, not when the transport is built.
+    with tracing.span("startup.vad"):
+        from pipecat.audio.vad.silero import SileroVADAnalyzer
+
+        return SileroVADAnalyzer()
+
+
+async def run_session(room_url, token, vad=None):
+    session = sessions.Session(tools.aevaluate_conditions)
+    logger.info(f"session {session.id} joining {room_url}")
+    if vad is None:
+        vad = await asyncio.to_thread(load_vad)
+
+    transport = DailyTransport(
+        room_url,
+        token,
+        "Respond bot",
+        DailyParams(
+            audio_out_enabled=True,
+            transcription_enabled=True,
+            vad_enabled=True,
+            vad_analyzer=vad,
+            audio_out_sample_rate=TransportPlayer.SAMPLE_RATE,
+        ),
+    )
 
-        tts = CartesiaTTSService(
-            api_key=os.getenv("CARTESIA_API_KEY"),
-            voice_id="79a125e8-cd45-4c13-8a67-188112f4dd22",  # British Lady
-        )
+    llm = AnthropicLLMService(api_key=os.getenv("ANTHROPIC_API_KEY"))
+    llm.register_function("get_current_image", functools.partial(get_current_image, session))
+    llm.register_function("recall_item", functools.partial(recall_item, session))
+    llm.register_function(
+        "wait_for_condition", functools.partial(wait_for_condition, session)
+    )
 
-        llm = AnthropicLLMService(api_key=os.getenv("ANTHROPIC_API_KEY"))
-        llm.register_function("get_current_image", get_current_image)
-        llm.register_function("recall_item", recall_item)
-        llm.register_function("wait_for_condition", wait_for_condition)
-
-        tools = [
-            {
-                "name": "get_current_image",
-                "description": "This will get the current user's image from the video stream. This tool should be used any time the user asks a question that may need a visual response.",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "user_request": {
-                            "type": "string",
-                            "description": "The user's request that requires a visual response. For example, 'What do you see in front of you?'",
-                        },
-                    },
-                    "required": ["user_request"],
-                },
-            },
-            {
-                "name": "recall_item",
-                "description": "Recall an item that the user is looking for",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "item": {
-                            "type": "string",
-                            "description": "The item that the user is looking for",
-                        },
-                        "user_query": {
-                            "type": "string",
-                            "description": "The user's full query for what they are looking for. For example, 'where did I leave my glasses?'",
-                        },
-                    },
-                    "required": ["item"],
-                },
-            },
-            {
-                "name": "wait_for_condition",
-                "description": "This tool is used to wait for a condition to be met in an image. The tool will keep asking the AI to analyze the image until the condition is met. This tool should be used if the user says something like 'Tell me when you see something blue'.",
-                "input_schema": {
-                    "type": "object",
-                    "properties": {
-                        "condition": {
-                            "type": "string",
-                            "description": "The condition to wait for in the image. For example, if the user says 'Tell me when you see a cat', the condition will be 'a cat appears in the image'.",
-                        }
-                    },
-                    "required": ["item"],
-                },
-            },
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+    ]
+
+    session.context = AnthropicLLMContext(messages, LLM_TOOLS)
+    context_aggregator = llm.create_context_aggregator(session.context)
+
+    pipeline = Pipeline(
+        [
+            transport.input(),
+            SessionFrames(session),
+            # context_aggregator.user(),
+            # llm,
+            transport.output(),
+            # context_aggregator.assistant(),
         ]
+    )
 
-        system_prompt = """\
-You are a helpful assistant who converses with a user and answers questions. Respond concisely to general questions.
+    task = PipelineTask(pipeline)
+    # replies are spoken into this room, not on the host
+    session.speaker = tools.get_speaker().routed(
+        functools.partial(TransportPlayer, task, asyncio.get_running_loop()),
+        TransportPlayer.OUTPUT_FORMAT,
+    )
+    dispatcher = tools.ToolDispatcher(
+        speculative=os.getenv("SPECULATIVE_TOOLS") == "1",
+        session=session,
+        early_start=os.getenv("EARLY_START") == "1",
+    )
 
-Your response will be turned into speech so use only simple words and punctuation.
+    @transport.event_handler("on_first_participant_joined")
+    async def on_first_participant_joined(transport, participant):
+        session.participant_id = participant["id"]
+        session.participants.add(participant["id"])
+        await transport.capture_participant_transcription(participant["id"])
+        # frames feed the session buffer for watches and the answer cache
+        await transport.capture_participant_video(
+            session.participant_id, framerate=VIDEO_FPS
+        )
+        # Kick off the conversation.
+        with tracing.span("startup.greeting", session=session.id):
+            await tools.asay("Hi! Ask me about anything!", session.speaker)
+
+    @transport.event_handler("on_participant_joined")
+    async def on_participant_joined(transport, participant):
+        session.participants.add(participant["id"])
+
+    @transport.event_handler("on_participant_left")
+    async def on_participant_left(transport, participant, reason):
+        session.participants.discard(participant["id"])
+        if participant["id"] == session.participant_id:
+            await task.queue_frame(EndFrame())
+
+    @transport.event_handler("on_transcription_message")
+    async def on_transcription_message(transport, message: Dict[str, Any]):
+        participant_id = message.get("participantId")
+        text = message.get("text")
+        is_final = message["rawResponse"]["is_final"]
+        logger.info(
+            f"[{session.id}] Transcription from {participant_id}: {text} (final: {is_final})"
+        )
 
-You have access to these tools:
-- get_current_image: You can use this tool to get the current user's image from the video stream. This tool should be used any time the user asks a question that may need a visual response. This should be the basic tool you use whenever a visual task is needed.
-- recall_item: This is used whenever the user asks you to recall an item. This tool is used for recalling items that the user is looking for from the past.
-- wait_for_condition: This tool is used to wait for a condition to be met in an image. The tool will keep asking the AI to analyze the image until the condition is met. This tool should be used if the user says something like 'Tell me when you see something blue'. When you use this tool, do not say anything to the user. Just wait for the condition to be met and then respond to the user.
+        if is_final:
+            tracing.start_request()
+            tracing.record(
+                "transcript", 0.0, participant_id=participant_id, session=session.id
+            )
+            dispatcher.submit(text)
+        else:
+            # a stable interim starts tool selection before the endpointer
+            dispatcher.interim(text)
 
-- Your output is directly streamed to the user.
-- Do not mention any tools you are using
-- Only use the tool, and do not say anything before using the tool.
-- Remember to be brief in your messages. Only say two sentences maximum.
-"""
-        messages = [
-            {"role": "system", "content": system_prompt},
-        ]
+    # with several sessions in one loop, Ctrl-C cancels main() and with it
+    # every session, rather than whichever runner registered last
+    runner = PipelineRunner(handle_sigint=False)
 
-        context = AnthropicLLMContext(messages, tools)
-        context_aggregator = llm.create_context_aggregator(context)
-
-        pipeline = Pipeline(
-            [
-                transport.input(),
-                # context_aggregator.user(),
-                # llm,
-                # tts,
-                transport.output(),
-                # context_aggregator.assistant(),
-            ]
-        )
+    try:
+        await runner.run(task)
+    finally:
+        await dispatcher.aclose()
+        await session.close()
+        logger.info(f"session {session.id} ended")
 
-        task = PipelineTask(pipeline)
-
-        @transport.event_handler("on_first_participant_joined")
-        async def on_first_participant_joined(transport, participant):
-            global video_participant_id
-            video_participant_id = participant["id"]
-            await transport.capture_participant_transcription(participant["id"])
-            await transport.capture_participant_video(video_participant_id, framerate=0)
-            # Kick off the conversation.
-            await tts.say("Hi! Ask me about anything!")
-
-        @transport.event_handler("on_transcription_message")
-        async def on_transcription_message(transport, message: Dict[str, Any]):
-            participant_id = message.get("participantId")
-            text = message.get("text")
-            is_final = message["rawResponse"]["is_final"]
-            logger.info(
-                f"Transcription from {participant_id}: {text} (final: {is_final})"
-            )
 
-            if is_final:
-                tools.use_user_input(text)
+async def rooms(http):
+    # DAILY_ROOMS is a JSON list of [room_url, token] pairs, one session
+    # each; without it the process serves the single configured room.
+    configured = os.getenv("DAILY_ROOMS")
+    if configured:
+        return [tuple(room) for room in json.loads(configured)]
+    return [await configure(http)]
 
-        runner = PipelineRunner()
 
-        await runner.run(task)
+async def main():
+    async with aiohttp.ClientSession() as http:
+        configured = await rooms(http)
+        # VAD models, API clients and connections, canned phrases and the
+        # image pipeline all load in parallel before anyone joins.
+        with tracing.span("startup.warm"):
+            vads, _ = await asyncio.gather(
+                asyncio.gather(*(asyncio.to_thread(load_vad) for _ in configured)),
+                tools.awarm_up(),
+            )
+        logger.info(tracing.startup.report())
+        await asyncio.gather(
+            *(
+                run_session(room_url, token, vad)
+                for (room_url, token), vad in zip(configured, vads)
+            )
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import time
+
+import frames
+import scene
+
+
+class Watch:
+    def __init__(self, watch_id, condition, callback, timeout, on_timeout, screen=None):
+        self.id = watch_id
+        self.condition = condition
+        self.screen = screen
+        self.callback = callback
+        self.on_timeout = on_timeout
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.result = asyncio.get_running_loop().create_future()
+
+    @property
+    def done(self):
+        return self.result.done()
+
+    async def wait(self):
+        # Returns the description once the condition is met; raises
+        # TimeoutError or CancelledError otherwise.
+        return await asyncio.shield(self.result)
+
+
+class WatchScheduler:
+    # Holds any number of "tell me when..." conditions and checks all of them
+    # against each evaluated frame with a single batched call. evaluate is an
+    # async callable taking ({watch_id: condition}, frame) and returning
+    # {watch_id: description} for the conditions that are met. source
+    # returns the frame to check and raises RuntimeError when there is none.
+    # prefilter maps a condition to a prefilter.Prefilter or None; screened
+    # conditions are looked at every frame and evaluated only on candidates,
+    # the rest wait for the change gate and the interval. pace returns a
+    # factor (>= 1) the pause between evaluations is stretched by, so polling
+    # backs off while the VLM is under pressure.
+    SCREEN_INTERVAL = 0.03
+
+    def __init__(
+        self,
+        evaluate,
+        interval=1.0,
+        gate=None,
+        source=frames.current,
+        prefilter=None,
+        pace=None,
+    ):
+        self._evaluate = evaluate
+        self._source = source
+        self._prefilter = prefilter
+        self._pace = pace
+        self.interval = interval
+        self._gate = gate or scene.ChangeGate()
+        self._watches = {}
+        self._ids = itertools.count(1)
+        self._wakeup = None
+        self._task = None
+        self.evaluations = 0
+
+    def __len__(self):
+        return len(self._watches)
+
+    def add(self, condition, callback=None, timeout=None, on_timeout=None):
+        screen = self._prefilter(condition) if self._prefilter is not None else None
+        watch = Watch(next(self._ids), condition, callback, timeout, on_timeout, screen)
+        self._watches[watch.id] = watch
+        # a new condition has never seen the current frame
+        self._gate = scene.ChangeGate(self._gate.threshold, self._gate.max_staleness)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return watch
+
+    def cancel(self, watch_id):
+        watch = self._watches.pop(watch_id, None)
+        if watch is not None and not watch.done:
+            watch.result.cancel()
+
+    def clear(self):
+        # Cancels every watch and returns how many there were.
+        ids = list(self._watches)
+        for watch_id in ids:
+            self.cancel(watch_id)
+        return len(ids)
+
+    async def close(self):
+        self.clear()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _expire(self):
+        now = time.monotonic()
+        for watch in list(self._watches.values()):
+            if watch.deadline is not None and now >= watch.deadline:
+                del self._watches[watch.id]
+                watch.result.set_exception(TimeoutError(watch.condition))
+                watch.result.exception()
+                if watch.on_timeout is not None:
+                    asyncio.ensure_future(_maybe_await(watch.on_timeout(watch)))
+
+    async def _run(self):
+        while True:
+            self._expire()
+            if not self._watches:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                frame = await asyncio.to_thread(self._source)
+            except RuntimeError:
+                await asyncio.sleep(self.interval)
+                continue
+            pending = await asyncio.to_thread(self._due, frame, dict(self._watches))
+            if not pending:
+                await asyncio.sleep(self.SCREEN_INTERVAL if self._screened() else 0.2)
+                continue
+            try:
+                met = await self._evaluate(
+                    {watch_id: w.condition for watch_id, w in pending.items()}, frame
+                )
+            except Exception as e:
+                print("ERROR: watch evaluation failed: " + repr(e))
+                met = {}
+            self.evaluations += 1
+            for watch_id, description in met.items():
+                watch = self._watches.pop(watch_id, None)
+                if watch is None or watch.done:
+                    continue
+                watch.result.set_result(description)
+                if watch.callback is not None:
+                    asyncio.ensure_future(_maybe_await(watch.callback(watch, description)))
+            # when every watch is screened, keep looking at camera rate
+            pause = self.SCREEN_INTERVAL if self._screened() else self.interval
+            if self._pace is not None:
+                pause *= self._pace()
+            await asyncio.sleep(pause)
+
+    def _screened(self):
+        return all(w.screen is not None for w in self._watches.values())
+
+    def _due(self, frame, watches):
+        # The watches worth a VLM call on this frame.
+        due = {}
+        gated = None
+        for watch_id, watch in watches.items():
+            if watch.screen is not None:
+                if watch.screen.should_escalate(frame):
+                    due[watch_id] = watch
+                continue
+            if gated is None:
+                gated = self._gate.should_check(frame)
+            if gated:
+                due[watch_id] = watch
+        return due
+
+
+async def _maybe_await(value):
+    if asyncio.iscoroutine(value):
+        await value